@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+from columnar_store import codes_dtype
+
+# columns users can crossfilter on, on top of year and borough
+CROSSFILTER_COLUMNS = ['contributing_factor_vehicle_1', 'vehicle_type_code1', 'crash_time']
+
+
+class BitmapIndex:
+    def __init__(self, df, columns=None, max_values=256):
+        """
+        :description: builds one packed bitset (1 bit per row) per distinct value of each indexed column,
+                      so filters resolve with bitwise ops instead of boolean masks over every row
+        :param df: cleaned collision df, indexed once at ingest
+        :param columns: label columns to index, 'year' (from crash_date) and 'borough' are always indexed
+        :param max_values: only the most frequent values of a column get a stored bitset, rarer ones are
+                           computed from the column's codes when queried to bound memory
+        """
+
+        self.n_rows = len(df)
+        self.bitmaps = {}
+        self.codes = {}
+
+        columns = ['year', 'borough'] + [col for col in (columns or CROSSFILTER_COLUMNS)
+                                         if col not in ('year', 'borough')]
+        for col in columns:
+            values = pd.to_datetime(df['crash_date']).dt.year if col == 'year' else df[col]
+            codes, categories = pd.factorize(values, use_na_sentinel=True)
+            labels = categories.tolist()
+            # keep the codes in the smallest dtype that fits, -1 still marks missing values
+            codes = codes.astype(codes_dtype(len(labels)))
+
+            # order values by frequency so the stored bitsets cover most rows
+            counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+            order = np.argsort(-counts, kind='stable')
+
+            self.codes[col] = (codes, {value: code for code, value in enumerate(labels)})
+            self.bitmaps[col] = {labels[code]: np.packbits(codes == code) for code in order[:max_values]}
+
+    def values(self, col):
+        """
+        :param col: indexed column
+        :return: returns the column's distinct values, most frequent first for those with a stored bitset
+        """
+        stored = list(self.bitmaps[col])
+        return stored + [value for value in self.codes[col][1] if value not in self.bitmaps[col]]
+
+    def all_rows(self):
+        """
+        :return: returns a bitset with every row set, the neutral element for AND
+        """
+        return np.packbits(np.ones(self.n_rows, dtype=bool))
+
+    def select(self, col, values):
+        """
+        :param col: indexed column
+        :param values: values to match, OR-ed together
+        :return: returns the packed bitset of rows whose col is any of values
+        """
+        bits = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        codes, lookup = self.codes[col]
+        for value in values:
+            if value in self.bitmaps[col]:
+                bits |= self.bitmaps[col][value]
+            elif value in lookup:
+                bits |= np.packbits(codes == lookup[value])
+        return bits
+
+    def query(self, yr_start=None, yr_end=None, boroughs=None, filters=None):
+        """
+        :param yr_start: start of year range, unbounded if None
+        :param yr_end: end of year range, unbounded if None
+        :param boroughs: boroughs to keep, all if empty
+        :param filters: dict mapping indexed columns to the values to keep, empty lists are ignored
+        :return: returns the packed bitset of rows matching every given condition
+        """
+        bits = self.all_rows()
+
+        if yr_start is not None or yr_end is not None:
+            years = [year for year in self.codes['year'][1]
+                     if (yr_start is None or year >= yr_start) and (yr_end is None or year <= yr_end)]
+            bits &= self.select('year', years)
+
+        if boroughs:
+            bits &= self.select('borough', boroughs)
+
+        for col, values in (filters or {}).items():
+            if values:
+                bits &= self.select(col, values)
+
+        return bits
+
+    def rows(self, bits):
+        """
+        :param bits: packed bitset from select or query
+        :return: returns the positions of the set rows
+        """
+        return np.flatnonzero(np.unpackbits(bits, count=self.n_rows))
+
+    def group_counts(self, rows, cols):
+        """
+        :param rows: positions of the rows to count, e.g. from rows(query(...))
+        :param cols: indexed columns to group by
+        :return: returns a df of every combination of cols found in rows with its 'count', counted over the
+                 columns' integer codes instead of their labels
+        """
+        codes = [self.codes[col][0][rows] for col in cols]
+        valid = np.logical_and.reduce([c >= 0 for c in codes])
+        sizes = [len(self.codes[col][1]) for col in cols]
+        combos, counts = np.unique(np.ravel_multi_index([c[valid] for c in codes], sizes), return_counts=True)
+
+        grouped = {}
+        for col, col_codes in zip(cols, np.unravel_index(combos, sizes)):
+            labels = np.array(list(self.codes[col][1]), dtype=object)  # lookup keys are in code order
+            grouped[col] = labels[col_codes]
+        grouped['count'] = counts
+        return pd.DataFrame(grouped)
+
+    @staticmethod
+    def count(bits):
+        """
+        :param bits: packed bitset from select or query
+        :return: returns the number of set rows
+        """
+        return int(np.unpackbits(bits).sum())
@@ -0,0 +1,160 @@
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+# file layout:
+#   MAGIC | version (uint16) | header length (uint32) | JSON header | padding | column buffers
+# every column buffer starts on an ALIGNMENT boundary so it can be viewed straight out of a memmap
+MAGIC = b'NYCCOL'
+VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<6sHI')
+
+COORDINATE_COLUMNS = ['latitude', 'longitude']
+
+
+class ColumnarStoreError(ValueError):
+    """Raised when a file is not a columnar store or was written by an incompatible version."""
+
+
+def codes_dtype(n_categories):
+    """
+    :param n_categories: number of distinct labels in a column
+    :return: returns the smallest integer dtype pandas itself uses for codes of that many categories,
+             so pd.Categorical.from_codes can keep the stored array without copying it
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _encode_column(series):
+    """
+    :param series: column of the cleaned dataset
+    :return: returns the array to store and the header entry describing it
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # store timestamps as int64 nanoseconds, which view back to datetime64[ns] for free
+        values = series.astype('datetime64[ns]').to_numpy().view(np.int64)
+        return values, {'kind': 'datetime'}
+
+    if series.name in COORDINATE_COLUMNS:
+        return series.to_numpy(dtype=np.float32), {'kind': 'numeric'}
+
+    if pd.api.types.is_numeric_dtype(series):
+        values = series.to_numpy()
+        # downcast counts to the smallest integer type, keep floats (which may hold NaN) as float32
+        if pd.api.types.is_integer_dtype(values):
+            values = pd.to_numeric(series, downcast='integer').to_numpy()
+        elif pd.api.types.is_float_dtype(values):
+            values = values.astype(np.float32)
+        return values, {'kind': 'numeric'}
+
+    # label columns are dictionary encoded: small integer codes plus a list of distinct strings
+    codes, categories = pd.factorize(series, use_na_sentinel=True)
+    return codes.astype(codes_dtype(len(categories))), {'kind': 'category',
+                                                         'categories': [str(c) for c in categories]}
+
+
+def write_columnar(df, path):
+    """
+    :param df: cleaned collision df
+    :param path: file to write the store to
+    """
+    buffers = []
+    columns = []
+    offset = 0
+    for name in df.columns:
+        values, entry = _encode_column(df[name])
+        values = np.ascontiguousarray(values)
+        offset += -offset % ALIGNMENT
+        entry.update(name=name, dtype=values.dtype.str, offset=offset, length=len(values))
+        columns.append(entry)
+        buffers.append((offset, values))
+        offset += values.nbytes
+
+    header = json.dumps({'rows': len(df), 'columns': columns}).encode()
+
+    # column offsets are relative to the data start, which is aligned after the header
+    data_start = _PREAMBLE.size + len(header)
+    data_start += -data_start % ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for column_offset, values in buffers:
+            f.seek(data_start + column_offset)
+            f.write(values.tobytes())
+        # make sure a trailing empty column still lies inside the file
+        f.truncate(data_start + offset)
+
+
+def read_columnar(path):
+    """
+    :param path: file written by write_columnar
+    :return: returns the cleaned collision df, with numeric columns backed directly by a read-only memmap
+             and label columns as categoricals over the memmapped codes
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ColumnarStoreError(f'{path} is too short to be a columnar store')
+        magic, version, header_length = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ColumnarStoreError(f'{path} is not a columnar store')
+        if version != VERSION:
+            raise ColumnarStoreError(f'{path} has version {version}, expected {VERSION}')
+        header = json.loads(f.read(header_length))
+
+    data_start = _PREAMBLE.size + header_length
+    data_start += -data_start % ALIGNMENT
+
+    # an empty dataset has no data to map
+    mapped = np.memmap(path, mode='r', dtype=np.uint8) if header['rows'] else np.empty(0, np.uint8)
+
+    data = {}
+    for entry in header['columns']:
+        dtype = np.dtype(entry['dtype'])
+        start = data_start + entry['offset']
+        values = mapped[start:start + entry['length'] * dtype.itemsize].view(dtype)
+        data[entry['name']] = _decode_column(values, entry)
+
+    return pd.DataFrame(data, copy=False)
+
+
+def _decode_column(values, entry):
+    """
+    :param values: array stored for a column
+    :param entry: header entry describing it
+    :return: returns the column as the dashboard uses it, without copying values
+    """
+    if entry['kind'] == 'datetime':
+        return values.view('datetime64[ns]')
+    if entry['kind'] == 'category':
+        return pd.Categorical.from_codes(values, categories=entry['categories'])
+    return values
+
+
+def compact(df):
+    """
+    :param df: cleaned collision df
+    :return: returns df with the dtypes read_columnar gives it, label columns as categoricals and coordinates
+             as float32, held in memory instead of a memmap
+    """
+    data = {}
+    for name in df.columns:
+        values, entry = _encode_column(df[name])
+        data[name] = _decode_column(values, entry)
+    return pd.DataFrame(data, copy=False)
+
+
+def row_bytes(df):
+    """
+    :param df: rows of the cleaned collision df
+    :return: returns the bytes per row of df once compacted, without the labels of categoricals which are
+             shared by every row
+    """
+    return sum(_encode_column(df[name])[0].itemsize for name in df.columns)
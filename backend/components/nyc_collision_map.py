@@ -1,9 +1,27 @@
 from nyc_open_data_api import NYCOpenDataAPI
+import numpy as np
+import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+from dash import Patch
 import components.sankey as sk
+import metrics
 
+# decimal places kept for map coordinates, 5 places is about a meter
+COORDINATE_DECIMALS = 5
 
-def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
+# pixel radius each density cell is drawn with, about a cell's width at the default zoom
+DENSITY_RADIUS = 6
+
+# density values are sent as integers from 0 to DENSITY_LEVELS, which keeps patches small
+DENSITY_LEVELS = 1000
+
+# titles of the density weights in the annotation
+DENSITY_LABELS = {'collisions': 'Collisions', 'injuries': 'Injuries', 'fatalities': 'Fatalities'}
+
+
+def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None, filters=None, index=None,
+                     weight=None):
     """
     :param df: given pandas df containing 'borough' column
     :param lat: name of latitude column
@@ -11,18 +29,22 @@ def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
     :param yr_start: start year of map
     :param yr_end: end year of map
     :param boroughs: selected boroughs of map
+    :param filters: dict mapping crossfilter columns to the values to keep, see NYCOpenDataAPI.crossfilter
+    :param index: BitmapIndex built over df, used to resolve the filters when given
+    :param weight: column of df holding how many collisions each row stands for when df is a sample
     :return: returns a plotly scatter mapbox figure centered on NYC with data filtered by params
     """
 
     # use class filter function to get requested data
-    filtered_df = NYCOpenDataAPI.filter_by_year_and_borough(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs)
+    with metrics.stage('generate_nyc_map', 'filter'):
+        filtered_df = NYCOpenDataAPI.crossfilter(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs,
+                                                 filters=filters, index=index)
+    metrics.observe_rows('generate_nyc_map', len(filtered_df))
 
     # find total crashes by borough for future use in annotation
-    total_crashes = len(filtered_df)
-    total_crashes_by_borough = {}
-    for borough in boroughs:
-        crashes_in_borough = len(filtered_df[filtered_df['borough'] == borough])
-        total_crashes_by_borough[borough] = crashes_in_borough
+    with metrics.stage('generate_nyc_map', 'aggregate'):
+        total_crashes_by_borough = _map_counts(filtered_df, boroughs, weight)
+        total_crashes = sum(total_crashes_by_borough.values())
 
     # set what info is displayed when a user hovers over each point
     hover_data = {
@@ -31,18 +53,25 @@ def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
         'borough': False
     }
 
-    # create a scatter mapbox plot with Plotly Express
-    fig = px.scatter_mapbox(filtered_df, lat=lat, lon=long, zoom=10, hover_data=hover_data,
-                            color='borough', hover_name='on_street_name')
+    # create a scatter mapbox plot with Plotly Express, with traces in the order of boroughs so
+    # generate_nyc_map_patch can address them by index. px only styles the traces, so it gets one row
+    # per borough and the points are filled in below
+    with metrics.stage('generate_nyc_map', 'figure'):
+        fig = px.scatter_mapbox(filtered_df.drop_duplicates('borough'), lat=lat, lon=long, zoom=10,
+                                hover_data=hover_data, color='borough', hover_name='on_street_name',
+                                category_orders={'borough': boroughs})
+
+        # send points as plain rounded lists, which patches can extend, and drop the unused customdata
+        for trace in fig.data:
+            trace.update(customdata=None,
+                         **_map_trace_arrays(filtered_df[filtered_df['borough'] == trace.name], lat, long))
 
     # assign custom size to points on map to reduce the size
     fig.update_traces(marker={'size': 3.25})
 
     # Update layout to set Mapbox style and focus on New York City
+    _style_map(fig)
     fig.update_layout(
-        mapbox_style='carto-positron',  # Use the Mapbox map style
-        mapbox_zoom=10,  # Adjust zoom level as needed
-        mapbox_center={'lat': 40.7128, 'lon': -74.0060},  # Coordinates for New York City
         legend=dict(
             title='Borough:',
             orientation='h',
@@ -63,7 +92,7 @@ def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
     for i, borough in enumerate(boroughs):
         borough_crashes = total_crashes_by_borough.get(borough, 0)
         fig.add_annotation(
-            text=f"{borough}: {borough_crashes}",
+            text=_map_count_text(borough, borough_crashes, weight),
             x=0,
             # set the start of the stack of texts just under the total collision count and adjust distance of following
             # annotations based on total number of boroughs
@@ -76,7 +105,70 @@ def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
 
     # annotate the total number of crashes
     fig.add_annotation(
-        text=f"Total Collisions: {total_crashes}",
+        text=_map_total_text(total_crashes, weight),
+        x=0,
+        y=1,
+        showarrow=False,
+        font=dict(size=24, color='black'),
+        bgcolor='rgba(255, 255, 255, 0.75)',  # set color, with opacity to 75%
+        opacity=0.9
+    )
+    return fig
+
+
+def _style_map(fig):
+    """
+    :param fig: figure with a mapbox trace
+    :return: returns fig with the dashboard's map style, zoom and center
+    """
+    fig.update_layout(
+        mapbox_style='carto-positron',  # Use the Mapbox map style
+        mapbox_zoom=10,  # Adjust zoom level as needed
+        mapbox_center={'lat': 40.7128, 'lon': -74.0060},  # Coordinates for New York City
+    )
+    return fig
+
+
+def generate_density_map(grid, yr_start=2012, yr_end=2023, boroughs=None, weight='collisions', positions=None,
+                         patch=False):
+    """
+    :param grid: DensityGrid built over the dataset
+    :param yr_start: start year of map
+    :param yr_end: end year of map
+    :param boroughs: selected boroughs of map
+    :param weight: 'collisions', 'injuries' or 'fatalities', what the density counts
+    :param positions: positions of the rows matching the view's other filters, None to sum the precomputed grids
+    :param patch: return a dash Patch of the values of an existing density map instead of a new figure
+    :return: returns a plotly density mapbox figure of the smoothed grid, whose size only depends on the grid
+    """
+
+    with metrics.stage('generate_density_map', 'aggregate'):
+        values, total = grid.query(yr_start, yr_end, boroughs=boroughs, weight=weight, positions=positions)
+
+        # saturate the colors at the densest cells so a few hotspots don't wash out the rest
+        nonzero = values[values > 0]
+        zmax = float(np.percentile(nonzero, 99)) if len(nonzero) else 1.0
+        z = np.rint(np.minimum(values / zmax, 1) * DENSITY_LEVELS).astype(int).tolist()
+        text = f"Total {DENSITY_LABELS[weight]}: {int(round(total))}"
+
+    # the cells drawn never change, so only their values and the total are replaced
+    if patch:
+        fig = Patch()
+        with metrics.stage('generate_density_map', 'figure'):
+            fig['data'][0]['z'] = z
+            fig['layout']['annotations'][0]['text'] = text
+        return fig
+
+    with metrics.stage('generate_density_map', 'figure'):
+        fig = go.Figure(go.Densitymapbox(lat=grid.lat[grid.cells].round(COORDINATE_DECIMALS).tolist(),
+                                         lon=grid.lon[grid.cells].round(COORDINATE_DECIMALS).tolist(),
+                                         z=z, zmin=0, zmax=DENSITY_LEVELS, radius=DENSITY_RADIUS, colorscale='YlOrRd',
+                                         showscale=False, hoverinfo='skip'))
+    _style_map(fig)
+
+    # annotate the total in the same place as the total number of crashes on the point map
+    fig.add_annotation(
+        text=text,
         x=0,
         y=1,
         showarrow=False,
@@ -87,51 +179,297 @@ def generate_nyc_map(df, lat, long, yr_start=2012, yr_end=2023, boroughs=None):
     return fig
 
 
-def generate_sankey(df, cols, yr_start=2012, yr_end=2023, boroughs=None):
+def _map_counts(filtered_df, boroughs, weight=None):
+    """
+    :param filtered_df: filtered rows of the map
+    :param boroughs: selected boroughs of map
+    :param weight: column holding how many collisions each row stands for, None to count rows
+    :return: returns the number of collisions of each borough, estimated from the weights of a sample
+    """
+    grouped = filtered_df.groupby('borough', observed=True)
+    totals = grouped[weight].sum().round() if weight else grouped.size()
+    return {borough: int(totals.get(borough, 0)) for borough in boroughs}
+
+
+def _map_count_text(borough, count, weight=None):
+    """
+    :return: returns the annotation text of a borough's collision count, marked as approximate for a sample
+    """
+    return f"{borough}: ~{count}" if weight else f"{borough}: {count}"
+
+
+def _map_total_text(count, weight=None):
+    """
+    :return: returns the annotation text of the total collision count, marked as approximate for a sample
+    """
+    return f"Total Collisions: ~{count} (sampled)" if weight else f"Total Collisions: {count}"
+
+
+def _map_trace_arrays(borough_df, lat, long):
+    """
+    :param borough_df: filtered rows of a single borough
+    :param lat: name of latitude column
+    :param long: name of longitude column
+    :return: returns the lat, lon and hovertext lists of the borough's map trace
+    """
+    located = borough_df.dropna(subset=[lat, long])
+    street = located['on_street_name'].astype(object)
+    return {'lat': located[lat].astype(float).round(COORDINATE_DECIMALS).tolist(),
+            'lon': located[long].astype(float).round(COORDINATE_DECIMALS).tolist(),
+            'hovertext': street.where(street.notna(), None).tolist()}
+
+
+def generate_nyc_map_patch(df, lat, long, yr_start, yr_end, boroughs, previous_years, previous_traces,
+                           filters=None, index=None, weight=None):
+    """
+    :param df: given pandas df containing 'borough' column
+    :param lat: name of latitude column
+    :param long: name of longitude column
+    :param yr_start: start year of map
+    :param yr_end: end year of map
+    :param boroughs: selected boroughs of map, the same list the current figure was generated with
+    :param previous_years: [start, end] year range of the current figure, None if its other filters changed
+    :param previous_traces: trace names of the current figure, in order
+    :param filters: dict mapping crossfilter columns to the values to keep, see NYCOpenDataAPI.crossfilter
+    :param index: BitmapIndex built over df, used to resolve the filters when given
+    :param weight: column of df holding how many collisions each row stands for when df is a sample
+    :return: returns a dash Patch updating only the points and annotation texts of the current figure, or None
+             if its traces no longer match and it has to be rebuilt with generate_nyc_map, and the trace names
+    """
+
+    # use class filter function to get requested data
+    with metrics.stage('generate_nyc_map_patch', 'filter'):
+        filtered_df = NYCOpenDataAPI.crossfilter(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs,
+                                                 filters=filters, index=index)
+    metrics.observe_rows('generate_nyc_map_patch', len(filtered_df))
+
+    with metrics.stage('generate_nyc_map_patch', 'aggregate'):
+        counts = _map_counts(filtered_df, boroughs, weight)
+
+    # a borough gaining or losing all of its points adds or removes a trace, which needs a full figure
+    traces = [borough for borough in boroughs if counts[borough]]
+    if traces != list(previous_traces):
+        return None, traces
+
+    patch = Patch()
+    with metrics.stage('generate_nyc_map_patch', 'figure'):
+        prev_start, prev_end = previous_years or (yr_start, yr_end)
+        if previous_years and yr_start <= prev_start and yr_end >= prev_end:
+            # the range only grew at its edges, so only send the points of the added years
+            crash_year = filtered_df['crash_date'].dt.year
+            added_df = filtered_df[(crash_year < prev_start) | (crash_year > prev_end)]
+            for i, borough in enumerate(traces):
+                arrays = _map_trace_arrays(added_df[added_df['borough'] == borough], lat, long)
+                for key, values in arrays.items():
+                    if values:
+                        patch['data'][i][key].extend(values)
+        else:
+            # patches can't drop a slice of points, so replace the coordinate arrays of every trace
+            for i, borough in enumerate(traces):
+                arrays = _map_trace_arrays(filtered_df[filtered_df['borough'] == borough], lat, long)
+                for key, values in arrays.items():
+                    patch['data'][i][key] = values
+
+        # annotations are stacked per borough followed by the total, as in generate_nyc_map
+        for i, borough in enumerate(boroughs):
+            patch['layout']['annotations'][i]['text'] = _map_count_text(borough, counts[borough], weight)
+        patch['layout']['annotations'][len(boroughs)]['text'] = _map_total_text(sum(counts.values()), weight)
+
+    return patch, traces
+
+
+def generate_sankey(df, cols, yr_start=2012, yr_end=2023, boroughs=None, patch=False, filters=None, index=None):
     """
     :param df: given pandas df containing 'borough' column
     :param cols: given list of column names of columns to group by
     :param yr_start: start year of map
     :param yr_end: end year of map
     :param boroughs: selected boroughs of map
+    :param patch: return a dash Patch of the links and labels of an existing sankey instead of a new figure
+    :param filters: dict mapping crossfilter columns to the values to keep, see NYCOpenDataAPI.crossfilter
+    :param index: BitmapIndex built over df, used to resolve the filters when given
     :return: returns a plotly sankey figure using given grouped data filtered by params
     """
 
     # use class filter function to get requested data
-    filtered_df = NYCOpenDataAPI.filter_by_year_and_borough(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs)
+    with metrics.stage('generate_sankey', 'filter'):
+        filtered_df = NYCOpenDataAPI.crossfilter(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs,
+                                                 filters=filters, index=index)
+    metrics.observe_rows('generate_sankey', len(filtered_df))
+
+    with metrics.stage('generate_sankey', 'aggregate'):
+        # group data by specified columns
+        grouped_df = filtered_df.groupby(cols, observed=True).size().reset_index(name='count')
+
+        # only include the top 20 counts for readability
+        grouped_df = grouped_df.sort_values(by='count', ascending=False).head(10)
+
+    with metrics.stage('generate_sankey', 'figure'):
+        fig = _sankey_patch(grouped_df, cols) if patch else sk.make_sankey(grouped_df, cols, vals='count')
+
+    return fig
+
+
+def _sankey_patch(grouped_df, cols):
+    """
+    :param grouped_df: top counts grouped by cols
+    :param cols: given list of column names the counts are grouped by
+    :return: returns a dash Patch replacing the links and node labels of an existing sankey figure
+    """
+    link, node = sk.make_link_and_node(grouped_df, cols, vals='count')
+
+    patch = Patch()
+    patch['data'][0]['link'] = {key: list(values) for key, values in link.items()}
+    patch['data'][0]['node']['label'] = node['label']
+    return patch
+
+
+def generate_sankey_from_counts(counts, cols, yr_start=2012, yr_end=2023, boroughs=None, patch=False,
+                                filters=None):
+    """
+    :param counts: df of collision counts from NYCOpenDataAPI.fetch_aggregate grouped by cols
+    :param cols: given list of column names of columns to group by
+    :param yr_start: start year of map
+    :param yr_end: end year of map
+    :param boroughs: selected boroughs of map
+    :param patch: return a dash Patch of the links and labels of an existing sankey instead of a new figure
+    :param filters: dict mapping grouped columns of counts to the values to keep
+    :return: returns the same plotly sankey figure as generate_sankey, built from pre-aggregated counts
+    """
 
-    # group data by specified columns
-    grouped_df = filtered_df.groupby(cols).size().reset_index(name='count')
+    # use class filter function to get requested counts
+    with metrics.stage('generate_sankey_from_counts', 'filter'):
+        filtered = NYCOpenDataAPI.filter_counts_by_year_and_borough(counts, yr_start=yr_start, yr_end=yr_end,
+                                                                    boroughs=boroughs, filters=filters)
+    metrics.observe_rows('generate_sankey_from_counts', len(filtered))
 
-    # only include the top 20 counts for readability
-    grouped_df = grouped_df.sort_values(by='count', ascending=False).head(10)
+    with metrics.stage('generate_sankey_from_counts', 'aggregate'):
+        # sum counts over the selected years and boroughs
+        grouped_df = filtered.groupby(cols)['count'].sum().reset_index()
 
-    fig = sk.make_sankey(grouped_df, cols, vals='count')
+        # only include the top 20 counts for readability
+        grouped_df = grouped_df.sort_values(by='count', ascending=False).head(10)
+
+    with metrics.stage('generate_sankey_from_counts', 'figure'):
+        fig = _sankey_patch(grouped_df, cols) if patch else sk.make_sankey(grouped_df, cols, vals='count')
 
     return fig
 
 
-def generate_hist(df, cols, yr_start=2012, yr_end=2023, boroughs=None):
+def generate_hist(df, cols, yr_start=2012, yr_end=2023, boroughs=None, patch=False, filters=None, index=None,
+                  weight=None):
     """
     :param df: given pandas df containing 'borough' column
     :param cols: given list of column names of columns to generate histogram of
     :param yr_start: start year of map
     :param yr_end: end year of map
     :param boroughs: selected boroughs of map
+    :param patch: return a dash Patch of the values of an existing histogram instead of a new figure
+    :param filters: dict mapping crossfilter columns to the values to keep, see NYCOpenDataAPI.crossfilter
+    :param index: BitmapIndex built over df, used to resolve the filters when given
+    :param weight: column of df holding how many collisions each row stands for when df is a sample
     :return: returns a plotly histogram figure using given columns filtered by the params
     """
 
     # use class filter function to get requested data
-    filtered_df = NYCOpenDataAPI.filter_by_year_and_borough(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs)
+    with metrics.stage('generate_hist', 'filter'):
+        filtered_df = NYCOpenDataAPI.crossfilter(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs,
+                                                 filters=filters, index=index)
+    metrics.observe_rows('generate_hist', len(filtered_df))
 
     if not isinstance(cols, list):
         cols = [cols]
 
+    # a sample's rows stand for different numbers of collisions, so sum their weights like counts
+    if weight:
+        with metrics.stage('generate_hist', 'aggregate'):
+            stacked = [filtered_df.groupby(col)[weight].sum().rename('count').reset_index() for col in cols]
+        return _hist_from_counts(stacked, cols, 'generate_hist', patch, sampled=True)
+
+    # only the values of each trace change between interactions
+    if patch:
+        fig = Patch()
+        with metrics.stage('generate_hist', 'figure'):
+            for i, col in enumerate(cols):
+                fig['data'][i]['x'] = filtered_df[col].tolist()
+        return fig
+
     # generate a histogram figure with histograms of each element in col and normalize histograms to percentage
-    fig = px.histogram(filtered_df, x=cols, histnorm='percent', barmode='overlay')
+    with metrics.stage('generate_hist', 'figure'):
+        fig = px.histogram(filtered_df, x=cols, histnorm='percent', barmode='overlay')
+
+    return _style_hist(fig, cols)
+
+
+def generate_hist_from_counts(counts, cols, yr_start=2012, yr_end=2023, boroughs=None, patch=False,
+                              filters=None):
+    """
+    :param counts: dict mapping each column in cols to its df of counts from NYCOpenDataAPI.fetch_aggregate
+    :param cols: given list of column names of columns to generate histogram of
+    :param yr_start: start year of map
+    :param yr_end: end year of map
+    :param boroughs: selected boroughs of map
+    :param patch: return a dash Patch of the values and counts of an existing histogram instead of a new figure
+    :param filters: dict mapping grouped columns of counts to the values to keep
+    :return: returns the same plotly histogram figure as generate_hist, built from pre-aggregated counts
+    """
+
+    if not isinstance(cols, list):
+        cols = [cols]
+
+    # sum each column's counts over the selected years and boroughs
+    with metrics.stage('generate_hist_from_counts', 'aggregate'):
+        stacked = []
+        for col in cols:
+            filtered = NYCOpenDataAPI.filter_counts_by_year_and_borough(counts[col], yr_start=yr_start,
+                                                                        yr_end=yr_end, boroughs=boroughs,
+                                                                        filters=filters)
+            stacked.append(filtered.groupby(col)['count'].sum().reset_index())
+
+    return _hist_from_counts(stacked, cols, 'generate_hist_from_counts', patch)
+
+
+def _hist_from_counts(stacked, cols, function, patch=False, sampled=False):
+    """
+    :param stacked: one df per column in cols, holding the column's values and a 'count' of each
+    :param cols: given list of column names the counts are grouped by
+    :param function: name of the calling generator, to label its metrics
+    :param patch: return a dash Patch of the values and counts of an existing histogram instead of a new figure
+    :param sampled: mark the histogram as estimated from a sample
+    :return: returns the same plotly histogram figure as generate_hist, built from the counts
+    """
+
+    # only the values and counts of each trace change between interactions
+    if patch:
+        fig = Patch()
+        with metrics.stage(function, 'figure'):
+            for i, (col, summed) in enumerate(zip(cols, stacked)):
+                fig['data'][i]['x'] = summed[col].tolist()
+                fig['data'][i]['y'] = summed['count'].tolist()
+        return fig
+
+    # stack the counts into one long df and weight each value by its count, so the percentages match
+    # a histogram of the raw rows
+    with metrics.stage(function, 'figure'):
+        long_df = pd.concat([pd.DataFrame({'variable': col, 'value': summed[col], 'count': summed['count']})
+                             for col, summed in zip(cols, stacked)], ignore_index=True)
+        fig = px.histogram(long_df, x='value', y='count', color='variable', histfunc='sum',
+                           histnorm='percent', barmode='overlay', category_orders={'variable': cols})
+
+    return _style_hist(fig, cols, sampled)
+
+
+def _style_hist(fig, cols, sampled=False):
+    """
+    :param fig: histogram figure with one trace per column in cols
+    :param cols: given list of column names the traces were built from
+    :param sampled: mark the title as estimated from a sample
+    :return: returns fig with the dashboard's titles, fonts and trace names
+    """
 
     # add a title and rename x-axis, y-axis, and legend
-    fig.update_layout(title='Frequency Of Variables By Individual Vehicle Collision')
+    title = 'Frequency Of Variables By Individual Vehicle Collision'
+    fig.update_layout(title=f'{title} (sampled)' if sampled else title)
     fig.update_layout(xaxis_title='Value')
     fig.update_layout(yaxis_title='Frequency (%)')
     fig.update_layout(legend_title_text='Variable')
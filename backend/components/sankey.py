@@ -49,13 +49,13 @@ def _code_mapping(df, src, targ):
     return df, labels
 
 
-def make_sankey(df, col_list, vals=None):
+def make_link_and_node(df, col_list, vals=None):
     """
 
     :param df: Dataframe containing columns in column list
     :param col_list: Target colum of labels
     :param vals: Thickness of the link for each row
-    :return: Generates a Sankey diagram using columns from col_list contained in df with values from vals
+    :return: Returns the link and node dicts of a Sankey diagram, without building the figure
     """
 
     # assign values to vals or if not vals are provided assign all values to 1
@@ -74,6 +74,20 @@ def make_sankey(df, col_list, vals=None):
     link = {'source': df['src'], 'target': df['targ'], 'value': values}
     node = {'label': labels}
 
+    return link, node
+
+
+def make_sankey(df, col_list, vals=None):
+    """
+
+    :param df: Dataframe containing columns in column list
+    :param col_list: Target colum of labels
+    :param vals: Thickness of the link for each row
+    :return: Generates a Sankey diagram using columns from col_list contained in df with values from vals
+    """
+
+    link, node = make_link_and_node(df, col_list, vals)
+
     # generate Sankey diagram
     sk = go.Sankey(link=link, node=node)
     fig = go.Figure(sk)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+# citywide grid covering the five boroughs, as ((lat_min, lat_max), (lon_min, lon_max))
+NYC_BOUNDS = ((40.49, 40.92), (-74.27, -73.68))
+
+# what each grid cell can count: collisions, or the people injured or killed in them
+DENSITY_WEIGHTS = {'collisions': None,
+                   'injuries': 'number_of_persons_injured',
+                   'fatalities': 'number_of_persons_killed'}
+
+
+def gaussian_matrix(n, sigma):
+    """
+    :param n: number of cells along the axis
+    :param sigma: standard deviation of the kernel in cells
+    :return: returns the n x n matrix that convolves a vector of n cells with a gaussian, so a grid is
+             smoothed along both axes with two matrix products
+    """
+    offsets = np.arange(n)[:, None] - np.arange(n)[None, :]
+    matrix = np.exp(-0.5 * (offsets / sigma) ** 2)
+    matrix[np.abs(offsets) > 4 * sigma] = 0
+    return (matrix / matrix[n // 2].sum()).astype(np.float32)
+
+
+class DensityGrid:
+    def __init__(self, df, lat, long, shape=(128, 128), bounds=NYC_BOUNDS, sigma=1.5):
+        """
+        :description: bins every collision into a fixed citywide grid once, keeping one grid of counts (and of
+                      injuries and fatalities) per (year, borough), so a density view sums a few grids instead of
+                      touching rows
+        :param df: cleaned collision df, binned once at ingest
+        :param lat: name of latitude column
+        :param long: name of longitude column
+        :param shape: number of (lat, lon) cells of the grid, 128 cells are about 370m across
+        :param bounds: ((lat_min, lat_max), (lon_min, lon_max)) covered by the grid
+        :param sigma: standard deviation of the gaussian smoothing, in cells
+        """
+
+        self.shape = shape
+        (lat_min, lat_max), (lon_min, lon_max) = bounds
+        n_lat, n_lon = shape
+
+        # cell of every row, -1 for rows without coordinates or outside the grid
+        rows = np.floor((df[lat].to_numpy(dtype=float) - lat_min) / (lat_max - lat_min) * n_lat)
+        cols = np.floor((df[long].to_numpy(dtype=float) - lon_min) / (lon_max - lon_min) * n_lon)
+        inside = (rows >= 0) & (rows < n_lat) & (cols >= 0) & (cols < n_lon)
+        self.cell = np.where(inside, rows * n_lon + cols, -1).astype(np.int32)
+
+        self.years = sorted(df['crash_date'].dt.year.unique().tolist())
+        self.boroughs = df['borough'].dropna().unique().tolist()
+        # a missing count adds nothing rather than turning every grid it lands in into NaN
+        self.weights = {name: (None if col is None else df[col].fillna(0).to_numpy(dtype=np.float32))
+                        for name, col in DENSITY_WEIGHTS.items()}
+
+        # one flat grid per weight, year and borough
+        year_idx = np.searchsorted(self.years, df['crash_date'].dt.year.to_numpy())
+        borough_idx = pd.Categorical(df['borough'], categories=self.boroughs).codes
+        keep = (self.cell >= 0) & (borough_idx >= 0)
+        n_cells = n_lat * n_lon
+        stratum = (year_idx[keep] * len(self.boroughs) + borough_idx[keep]).astype(np.int64)
+        key = stratum * n_cells + self.cell[keep]
+        size = len(self.years) * len(self.boroughs) * n_cells
+        self.grids = {name: np.bincount(key, weights=None if weights is None else weights[keep], minlength=size)
+                      .astype(np.float32).reshape(len(self.years), len(self.boroughs), n_cells)
+                      for name, weights in self.weights.items()}
+
+        self.smooth_lat = gaussian_matrix(n_lat, sigma)
+        self.smooth_lon = gaussian_matrix(n_lon, sigma)
+
+        # cell centers, and the cells that hold any collision over the whole history once smoothed, which
+        # are the only ones drawn
+        lat_centers = lat_min + (np.arange(n_lat) + 0.5) * (lat_max - lat_min) / n_lat
+        lon_centers = lon_min + (np.arange(n_lon) + 0.5) * (lon_max - lon_min) / n_lon
+        self.lat, self.lon = [a.ravel() for a in np.meshgrid(lat_centers, lon_centers, indexing='ij')]
+        self.cells = np.flatnonzero(self.smooth(self.grids['collisions'].sum(axis=(0, 1))) > 1e-3)
+
+    def smooth(self, grid):
+        """
+        :param grid: flat grid of shape[0] * shape[1] cells
+        :return: returns the grid smoothed with a separable gaussian, still flat
+        """
+        return (self.smooth_lat @ grid.reshape(self.shape) @ self.smooth_lon.T).ravel()
+
+    def query(self, yr_start, yr_end, boroughs=None, weight='collisions', positions=None):
+        """
+        :param yr_start: start of year range
+        :param yr_end: end of year range
+        :param boroughs: boroughs to include, all if empty
+        :param weight: key of DENSITY_WEIGHTS to sum in each cell
+        :param positions: positions of the rows to bin instead of the precomputed grids, for views with
+                          other filters
+        :return: returns the smoothed values of the drawn cells and the total of the weight in the view
+        """
+        if positions is not None:
+            cell = self.cell[positions]
+            weights = self.weights[weight]
+            keep = cell >= 0
+            grid = np.bincount(cell[keep], weights=None if weights is None else weights[positions][keep],
+                               minlength=self.shape[0] * self.shape[1]).astype(np.float32)
+        else:
+            years = [i for i, year in enumerate(self.years) if yr_start <= year <= yr_end]
+            borough_idx = [i for i, borough in enumerate(self.boroughs) if not boroughs or borough in boroughs]
+            grid = self.grids[weight][np.ix_(years, borough_idx)].sum(axis=(0, 1))
+
+        return self.smooth(grid)[self.cells], float(grid.sum())
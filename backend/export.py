@@ -0,0 +1,170 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+from flask import Response, abort, request
+
+import metrics
+from bitmap_index import CROSSFILTER_COLUMNS
+
+FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+# rows converted per batch, which bounds the memory an export needs regardless of its size
+BATCH_ROWS = 100_000
+
+
+class _StreamSink:
+    def __init__(self):
+        """
+        :description: write-only file handed to the arrow writers, whose bytes are drained after every batch.
+                      tell() keeps counting drained bytes so a parquet footer's offsets stay correct
+        """
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        """
+        :return: returns the bytes written since the last drain
+        """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def view_from_args(args, yr_min, yr_max, loaded_from=None):
+    """
+    :param args: query string of the request, e.g. flask's request.args
+    :param yr_min: year range start when the query has none
+    :param yr_max: year range end when the query has none
+    :param loaded_from: first year loaded when --memory-budget left older ones out
+    :return: returns the year range, boroughs and crossfilters of the query, raises ValueError if the years
+             aren't integers or reach back before loaded_from
+    """
+    try:
+        yr_start = int(args.get('yr_start', yr_min))
+        yr_end = int(args.get('yr_end', yr_max))
+    except ValueError:
+        raise ValueError('yr_start and yr_end must be integers')
+    if loaded_from is not None and yr_start < loaded_from:
+        raise ValueError(f'only years {loaded_from} to {yr_max} are loaded, yr_start must be at least '
+                         f'{loaded_from}')
+
+    filters = {col: args.getlist(col) for col in CROSSFILTER_COLUMNS if col in args}
+    return yr_start, yr_end, args.getlist('borough'), filters
+
+
+def matching_rows(df, yr_start, yr_end, boroughs=None, filters=None, index=None):
+    """
+    :param df: cleaned collision df
+    :param yr_start: start of year range
+    :param yr_end: end of year range
+    :param boroughs: boroughs to keep, all if empty
+    :param filters: dict mapping columns to the values to keep, empty lists are ignored
+    :param index: BitmapIndex built over df, resolves the filters with bitwise ops when given
+    :return: returns the positions of the matching rows, without copying any of them
+    """
+    if index is not None:
+        return index.rows(index.query(yr_start, yr_end, boroughs, filters))
+
+    year = df['crash_date'].dt.year
+    mask = (year >= yr_start) & (year <= yr_end)
+    if boroughs:
+        mask &= df['borough'].isin(boroughs)
+    for col, values in (filters or {}).items():
+        if values:
+            mask &= df[col].isin(values)
+    return np.flatnonzero(mask.to_numpy())
+
+
+def iter_batches(df, positions, batch_rows=BATCH_ROWS):
+    """
+    :param df: cleaned collision df
+    :param positions: positions of the rows to export
+    :param batch_rows: rows per batch
+    :return: yields the rows at positions as dfs of at most batch_rows rows
+    """
+    for start in range(0, len(positions), batch_rows):
+        yield df.iloc[positions[start:start + batch_rows]]
+
+
+def _arrow_schema(df):
+    """
+    :param df: cleaned collision df
+    :return: returns the arrow schema every batch is converted to, so batches whose text columns happen
+             to be all missing still match the first one
+    """
+    schema = pa.Schema.from_pandas(df.head(0), preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+
+def stream_export(df, batches, fmt):
+    """
+    :param df: cleaned collision df the batches are taken from
+    :param batches: dfs of rows to export
+    :param fmt: 'csv' or 'parquet'
+    :return: yields the file as each batch is written, as CSV lines or as one parquet row group per batch
+    """
+    schema = _arrow_schema(df)
+    sink = _StreamSink()
+    writer_class = pcsv.CSVWriter if fmt == 'csv' else pq.ParquetWriter
+    with writer_class(sink, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+            yield sink.drain()
+    yield sink.drain()  # a parquet footer is written on close
+
+
+def register(server, df, index=None, loaded_from=None, partial_year=None, batch_rows=BATCH_ROWS):
+    """
+    :description: adds the /export route, which streams the rows matching the query's filters, e.g.
+                  /export?format=csv&yr_start=2020&yr_end=2023&borough=Queens&vehicle_type_code1=Sedan
+    :param server: the Flask server behind the Dash app (app.server)
+    :param df: cleaned collision df to export from
+    :param index: BitmapIndex built over df, used to find the matching rows when given
+    :param loaded_from: first year in df when --memory-budget left older ones out, ranges starting earlier are
+                        rejected rather than exported incomplete
+    :param partial_year: year of which df only holds the most recent rows, exports covering it say so in their
+                         X-Partial-Year header
+    :param batch_rows: rows converted per batch
+    """
+    yr_min, yr_max = df['crash_date'].min().year, df['crash_date'].max().year
+    if loaded_from is not None:
+        yr_min = loaded_from
+
+    @server.route('/export')
+    def _export():
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            abort(400, f"format must be one of {', '.join(FORMATS)}")
+        try:
+            yr_start, yr_end, boroughs, filters = view_from_args(request.args, yr_min, yr_max, loaded_from)
+        except ValueError as e:
+            abort(400, str(e))
+
+        positions = matching_rows(df, yr_start, yr_end, boroughs=boroughs, filters=filters, index=index)
+        metrics.observe_rows('export', len(positions))
+
+        headers = {'Content-Disposition': f'attachment; filename=collisions_{yr_start}_{yr_end}.{fmt}'}
+        if partial_year is not None and yr_start <= partial_year <= yr_end:
+            headers['X-Partial-Year'] = str(partial_year)
+
+        batches = iter_batches(df, positions, batch_rows)
+        return Response(stream_export(df, batches, fmt), mimetype=FORMATS[fmt], headers=headers)
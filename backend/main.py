@@ -2,13 +2,26 @@ import os
 from dotenv import load_dotenv
 
 import argparse
+import json
+import time
+from urllib.parse import urlencode
 
 import pandas as pd
+import pyarrow.parquet as pq
 
 import components.nyc_collision_map as nd
+import export
+import metrics
+import query_api
+from bitmap_index import BitmapIndex, CROSSFILTER_COLUMNS
+from columnar_store import write_columnar, read_columnar, compact
+from density_grid import DensityGrid
+from memory_budget import ESTIMATE_ROWS, estimate_row_bytes, process_rss, read_parquet_years, resident_years, \
+    rows_within_budget
+from stratified_sample import StratifiedSample, WEIGHT_COLUMN
 from nyc_open_data_api import NYCOpenDataAPI
 
-from dash import Dash, dcc, html, Input, Output, State
+from dash import Dash, dcc, html, no_update, Input, Output, State
 import dash_bootstrap_components as dbc
 
 
@@ -27,6 +40,13 @@ COLUMNS = ['crash_date',
            'number_of_persons_injured',
            'number_of_persons_killed']
 CACHE_FILE = 'collision_data.parquet'
+COLUMNAR_CACHE_FILE = 'collision_data.ncol'
+REFRESH_STATE_FILE = 'collision_data.refresh.json'
+AGGREGATE_CACHE_DIR = 'aggregate_cache'
+HIST_COLUMNS = ['number_of_persons_injured', 'number_of_persons_killed']
+CROSSFILTER_LABELS = {'contributing_factor_vehicle_1': 'Contributing Factor',
+                      'vehicle_type_code1': 'Vehicle Type',
+                      'crash_time': 'Time Of Collision'}
 
 
 def parse_args():
@@ -42,14 +62,32 @@ def parse_args():
     parser.add_argument('--limit', type=int,
                         default=50000 if os.getenv('RENDER') else 250000,
                         help='Number of rows to fetch from the API')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='Megabytes the dashboard may use, keeps the newest years that fit in memory instead '
+                             'of --limit rows and summarizes older ones from aggregates')
     parser.add_argument('--yr-start', type=int, default=2024,
                         help='Default start year for the year range slider')
     parser.add_argument('--yr-end', type=int, default=2025,
                         help='Default end year for the year range slider')
     parser.add_argument('--refresh', action='store_true', default=False,
-                    help='Force refresh data from API, ignoring cache')
+                    help='Refresh data from the API if the portal has changed it since the cache was fetched')
     parser.add_argument('--port', type=int, default=8050,
                         help='Port to run the dashboard on')
+    parser.add_argument('--cache-format', type=str, choices=['parquet', 'columnar'], default='parquet',
+                        help='On-disk format of the cleaned dataset, columnar loads much faster')
+    parser.add_argument('--aggregate', action='store_true', default=False,
+                        help='Serve the Sankey and histogram from server-side aggregate queries over the full history')
+    parser.add_argument('--sample-size', type=int, default=150,
+                        help='Rows kept per year and borough in the stratified sample used by approximate views')
+    # drawing and serialising the exact map costs about 120ms plus 7.5ms per 1000 points, so past 20000
+    # points an exact view no longer comes back in about 250ms
+    parser.add_argument('--approximate-above', type=int, default=20000,
+                        help='Draw the map and histogram from the sample first when a view covers more rows '
+                             '(0 disables approximate views)')
+    parser.add_argument('--profile-sample-rate', type=float, default=0.0,
+                        help='Fraction of callbacks to run under a profiler (0 disables profiling)')
+    parser.add_argument('--profile-slow-ms', type=int, default=500,
+                        help='Keep profiles of sampled callbacks slower than this many milliseconds')
     parser.add_argument('--debug', action='store_true', default=True,
                         help='Run in debug mode')
     parser.add_argument('--no-debug', action='store_false', dest='debug',
@@ -60,25 +98,235 @@ def parse_args():
 args = parse_args()
 
 # initialize the API
-api = NYCOpenDataAPI(args.url, args.key)
+api = NYCOpenDataAPI(args.url, args.key, cache_dir=AGGREGATE_CACHE_DIR)
+
+# settings the cache is fetched with, a refresh with other settings always fetches again
+refresh_query = {'url': args.url, 'memory_budget': args.memory_budget} if args.memory_budget \
+    else {'url': args.url, 'limit': args.limit}
+
+def clean_rows(data):
+    """
+    :param data: rows fetched from the API
+    :return: returns the rows cleaned like the cache
+    """
+    fetched = api.process_strings(data)
+    fetched['crash_time'] = api.convert_time_col_to_ranges(fetched, 'crash_time')
+    fetched['crash_date'] = pd.to_datetime(fetched['crash_date'])
+    return fetched
+
+def fetch_and_clean(limit, yr_start=2000):
+    """
+    :param limit: number of rows to fetch, newest first
+    :param yr_start: first year to fetch
+    :return: returns the fetched rows, cleaned
+    """
+    return clean_rows(api.fetch_data(columns=COLUMNS, limit=limit, yr_start=yr_start))
+
+def read_refresh_state():
+    """
+    :return: returns the state saved with the parquet cache by the last refresh, None if there is none or the
+             cache was fetched with other settings
+    """
+    if not (os.path.exists(CACHE_FILE) and os.path.exists(REFRESH_STATE_FILE)):
+        return None
+    with open(REFRESH_STATE_FILE) as f:
+        state = json.load(f)
+    return state if state.get('query') == refresh_query else None
+
+def write_refresh_state(validators, kept=None):
+    """
+    :param validators: validators of the API's answer to the cached rows, see NYCOpenDataAPI.fetch_data_if_modified
+    :param kept: what --memory-budget kept of the dataset when the cache was cut to it, see load_within_budget
+    """
+    with open(REFRESH_STATE_FILE, 'w') as f:
+        json.dump({'query': refresh_query, 'rows_updated_at': rows_updated_at, 'validators': validators,
+                   'checked_at': int(time.time()), 'kept': kept}, f)
+
+def read_cache_kept():
+    """
+    :return: returns what --memory-budget kept of the dataset when the cache was cut to it, whatever settings
+             the cache was fetched with, None if the cache holds every row it was fetched for
+    """
+    if not (os.path.exists(CACHE_FILE) and os.path.exists(REFRESH_STATE_FILE)):
+        return None
+    with open(REFRESH_STATE_FILE) as f:
+        return json.load(f).get('kept')
+
+def refresh_cache(limit, yr_start=2000, kept=None):
+    """
+    :param limit: number of rows to fetch, newest first
+    :param yr_start: first year to fetch
+    :param kept: what --memory-budget kept of the dataset when the rows are cut to it, saved with the cache
+    :return: returns the cleaned rows, fetched and written to the parquet cache, or read back from the cache
+             when the API answers that they haven't changed since they were cached
+    """
+    # the cached rows only stand in for a 304 when they were cut the same way
+    validators = refresh_state['validators'] if refresh_state and refresh_state.get('kept') == kept else None
+    data, validators, modified = api.fetch_data_if_modified(validators, columns=COLUMNS, limit=limit,
+                                                            yr_start=yr_start)
+    metrics.record_cache('refresh', not modified)
+    if modified:
+        fetched = clean_rows(data)
+        fetched.to_parquet(CACHE_FILE)
+    else:
+        print('Rows not modified since they were cached, loading from cache...')
+        fetched = pd.read_parquet(CACHE_FILE)
+    write_refresh_state(validators, kept)
+    return fetched
+
+def cache_covers(first_year, n_rows):
+    """
+    :param first_year: first year to keep resident, None if the years aren't known
+    :param n_rows: number of rows to keep resident
+    :return: returns True if the cache holds the newest n_rows rows from first_year, which a cache cut to a
+             smaller --memory-budget may not
+    """
+    if cache_kept is None:
+        return True
+    kept_from = cache_kept['first_year']
+    if first_year is None or kept_from is None:
+        return first_year == kept_from and cache_kept['rows'] >= n_rows
+    return kept_from < first_year or (kept_from == first_year and cache_kept['rows'] >= n_rows)
+
+def load_within_budget(budget_mb):
+    """
+    :param budget_mb: memory the dashboard may use, in megabytes
+    :return: returns the newest rows that fit in the budget, compacted, the first year resident when older
+             years were left out (None if every year is, or if it isn't known), and the year of which only the
+             most recent rows are resident, None if every resident year is whole
+    """
+    # count the rows of every year from the portal's aggregates, or else from the counts saved with a cache cut
+    # to an earlier budget, and only count the cache itself when it holds every row
+    aggregate = api.fetch_aggregate([])
+    if aggregate is not None:
+        year_counts = aggregate.groupby('year')['count'].sum()
+    elif cache_kept is not None and cache_kept['year_counts'] is not None:
+        year_counts = pd.Series({int(year): count for year, count in cache_kept['year_counts'].items()})
+    else:
+        year_counts = None
+
+    # read a few rows to price them, without loading the dataset
+    if cache_hit and args.cache_format == 'columnar':
+        mapped = read_columnar(cache_file)
+        rows = mapped.iloc[:ESTIMATE_ROWS]
+        cached_years = mapped['crash_date'].dt.year
+    elif cache_hit:
+        rows = next(pq.ParquetFile(cache_file).iter_batches(batch_size=ESTIMATE_ROWS)).to_pandas()
+        cached_years = pd.read_parquet(cache_file, columns=['crash_date'])['crash_date'].dt.year
+    else:
+        rows = fetch_and_clean(ESTIMATE_ROWS)
+    if year_counts is None and cache_hit and cache_kept is None:
+        year_counts = cached_years.value_counts()
+
+    row_cost = estimate_row_bytes(rows)
+    max_rows = rows_within_budget(budget_mb * 1e6, row_cost, used_bytes=process_rss())
+    if year_counts is None:
+        first_year, n_rows = None, max_rows
+    else:
+        first_year, n_rows = resident_years(year_counts, max_rows)
+    print(f'Memory budget of {budget_mb}MB fits {max_rows:,} rows at ~{row_cost:.0f} bytes each, '
+          f'keeping {n_rows:,} rows' + (f' from {first_year}' if first_year else ''))
+
+    if not (cache_hit and cache_covers(first_year, n_rows)):
+        # save what was kept with the cache, so later runs don't mistake it for the whole dataset
+        kept = None if year_counts is not None and n_rows >= year_counts.sum() else \
+            {'budget_mb': budget_mb, 'first_year': first_year, 'rows': n_rows,
+             'year_counts': None if year_counts is None else {str(year): int(count)
+                                                              for year, count in year_counts.items()}}
+        print('Fetching from API...')
+        resident = refresh_cache(n_rows, yr_start=first_year or 2000, kept=kept)
+        if args.cache_format == 'columnar':
+            write_columnar(resident, cache_file)
+    elif args.cache_format == 'columnar':
+        print('Loading from cache...')
+        resident = mapped[mapped['crash_date'].dt.year >= (first_year or 0)]
+    else:
+        print('Loading from cache...')
+        resident = read_parquet_years(cache_file, first_year or 1)
+
+    # cached rows are newest first, but make sure a partly kept year keeps its most recent rows
+    if len(resident) > n_rows:
+        resident = resident.sort_values('crash_date', ascending=False, kind='stable').head(n_rows)
+    resident = compact(resident.reset_index(drop=True))
+
+    if first_year is None or n_rows >= year_counts.sum():
+        return resident, None, None
+    return resident, first_year, first_year if n_rows < year_counts[first_year] else None
 
 # if data cached, retrieve it, else
 # fetch and clean the relevant data
-if os.path.exists(CACHE_FILE) and not args.refresh:
+cache_file = COLUMNAR_CACHE_FILE if args.cache_format == 'columnar' else CACHE_FILE
+
+# on --refresh, or without a cache, check when the portal last changed the rows, which is a small metadata
+# request. A refresh keeps the cache while the rows are unchanged since it was fetched
+rows_updated_at = api.rows_updated_at() if args.refresh or not os.path.exists(cache_file) else None
+refresh_state = read_refresh_state()
+cache_kept = read_cache_kept()
+unchanged = refresh_state is not None and rows_updated_at is not None and \
+    rows_updated_at == refresh_state['rows_updated_at']
+if args.refresh and unchanged:
+    print('Dataset unchanged since the cache was fetched, keeping it')
+    write_refresh_state(refresh_state['validators'], cache_kept)
+elif args.refresh:
+    api.clear_aggregate_cache()
+
+# a cache cut to a --memory-budget is only reused by budget runs, which check it holds the rows they keep
+cache_hit = os.path.exists(cache_file) and (not args.refresh or unchanged) and \
+    (args.memory_budget is not None or cache_kept is None)
+metrics.record_cache(args.cache_format, cache_hit)
+loaded_from, partial_year = None, None
+if args.memory_budget:
+    df, loaded_from, partial_year = load_within_budget(args.memory_budget)
+elif cache_hit:
     print('Loading from cache...')
-    df = pd.read_parquet(CACHE_FILE)
+    df = read_columnar(cache_file) if args.cache_format == 'columnar' else pd.read_parquet(cache_file)
+elif args.cache_format == 'columnar' and os.path.exists(CACHE_FILE) and (not args.refresh or unchanged) and \
+        cache_kept is None:
+    # convert an existing parquet cache rather than fetching again
+    print('Converting parquet cache to columnar...')
+    write_columnar(pd.read_parquet(CACHE_FILE), cache_file)
+    df = read_columnar(cache_file)
 else:
     print('Fetching from API...')
-    data = api.fetch_data(columns=COLUMNS, limit=args.limit)
-    df = api.process_strings(data)
-    df['crash_time'] = api.convert_time_col_to_ranges(df, 'crash_time')
-    df['crash_date'] = pd.to_datetime(df['crash_date'])
-    df.to_parquet(CACHE_FILE)
+    df = refresh_cache(args.limit)
+    if args.cache_format == 'columnar':
+        write_columnar(df, cache_file)
+        df = read_columnar(cache_file)
+
+# index the crossfilter columns once so every interaction resolves its filters with bitwise ops
+index = BitmapIndex(df, columns=CROSSFILTER_COLUMNS)
+
+# sample every year and borough once so views over many rows can be drawn quickly, then refined
+sample = StratifiedSample(df, per_stratum=args.sample_size, columns=CROSSFILTER_COLUMNS) \
+    if args.approximate_above else None
+
+# bin every collision into a citywide grid per year and borough once, for the density layer
+density = DensityGrid(df, 'latitude', 'longitude')
+
+# the slider covers the loaded rows, or the full history when summary views come from aggregates
+yr_min, yr_max = df['crash_date'].min().year, df['crash_date'].max().year
+# years before this one were left out by --memory-budget, their summary views come from aggregates
+aggregate_before = None
+if args.aggregate or loaded_from:
+    year_counts = api.fetch_aggregate([])
+    if year_counts is not None:
+        yr_min, yr_max = int(year_counts['year'].min()), int(year_counts['year'].max())
+        # a partly resident year is counted from aggregates as well
+        aggregate_before = partial_year + 1 if partial_year else loaded_from
 
 # initialize plotly dashboard and server
 app = Dash(__name__, external_stylesheets=[dbc.themes.FLATLY], assets_folder='../frontend/assets')
 server = app.server  # start server
 
+# expose callback timings and payload sizes at /metrics
+metrics.register(server, profile_sample_rate=args.profile_sample_rate, profile_slow_ms=args.profile_slow_ms)
+
+# stream the rows behind the current view at /export, refusing years --memory-budget didn't fully load
+export.register(server, df, index=index, loaded_from=loaded_from, partial_year=partial_year)
+
+# answer the dashboard's counts as JSON under /api/v1, from the same bitmap index
+query_api.register(server, df, index=index, loaded_from=loaded_from, partial_year=partial_year)
+
 app.layout = dbc.Container([
 
     # Row 1: Title
@@ -92,34 +340,91 @@ app.layout = dbc.Container([
     # Store the currently toggled boroughs
     dcc.Store(id='active_boroughs', data=df['borough'].dropna().unique().tolist()),
 
+    # Store what each figure was last drawn with, so later updates can patch it instead of rebuilding it
+    dcc.Store(id='nyc_map_state'),
+    dcc.Store(id='sankey_state'),
+    dcc.Store(id='histogram_state'),
+
+    # Store the view a sampled figure still has to be drawn exactly for, which triggers the exact redraw
+    dcc.Store(id='nyc_map_exact'),
+    dcc.Store(id='histogram_exact'),
+
+    # Store the values selected in the crossfilter dropdowns, by column
+    dcc.Store(id='crossfilters', data={}),
+
+    # Store the crossfilter set by clicking a sankey node, applied to the map and histogram
+    dcc.Store(id='sankey_filter', data={}),
+
     # Row 2: Year Range Slider
     dbc.Row(
         dbc.Col([
             html.Label('Select Year Range:', className='dashboard-label'),
             dcc.RangeSlider(
                 id='year_range_slider',
-                min=df['crash_date'].min().year,
-                max=df['crash_date'].max().year,
+                min=yr_min,
+                max=yr_max,
                 step=1,
-                marks={year: str(year) for year in range(
-                    df['crash_date'].min().year,
-                    df['crash_date'].max().year + 1)},
+                marks={year: str(year) for year in range(yr_min, yr_max + 1)},
                 value=[args.yr_start, args.yr_end],
                 tooltip={"placement": "bottom", "always_visible": True}
             )
+        ] + ([
+            # years left out by --memory-budget only have counts, not rows to plot
+            html.Div(f'The map only plots the most recent {len(df):,} collisions of {partial_year}, the Sankey and '
+                     'histogram count every collision' if partial_year else
+                     f'The map covers {loaded_from} onwards, earlier years are counted in the Sankey and '
+                     'histogram only', className='dashboard-checklist')
+        ] if aggregate_before else []), width=12), className='mb-3'
+    ),
+
+    # Row 3: Crossfilter dropdowns, values within a dropdown are OR-ed and dropdowns are AND-ed
+    dbc.Row([
+        dbc.Col([
+            html.Label(f'{label}:', className='dashboard-label'),
+            dcc.Dropdown(
+                id=f'{col}_filter',
+                options=sorted(index.values(col)),
+                multi=True,
+                placeholder='All'
+            )
+        ], xs=12, lg=4) for col, label in CROSSFILTER_LABELS.items()
+    ], className='mb-3'),
+
+    # Row 4: Download the rows behind the current histogram
+    dbc.Row(
+        dbc.Col([
+            html.A('Download CSV', id='export_csv', className='dashboard-label me-3'),
+            html.A('Download Parquet', id='export_parquet', className='dashboard-label')
         ], width=12), className='mb-3'
     ),
 
-# Row 3: Full-width Map with Borough Toggle
+# Row 5: Full-width Map with Borough Toggle and Layer Selection
 dbc.Row(
     dbc.Col([
+        dcc.RadioItems(
+            id='map_layer',
+            options=[
+                {'label': ' Collisions', 'value': 'points'},
+                {'label': ' Density', 'value': 'density'}
+            ],
+            value='points',
+            inline=True,
+            className='dashboard-checklist'
+        ),
+        dcc.RadioItems(
+            id='density_weight',
+            options=[{'label': f' {label}', 'value': weight} for weight, label in nd.DENSITY_LABELS.items()],
+            value='collisions',
+            inline=True,
+            className='dashboard-checklist'
+        ),
         dcc.Graph(id='nyc_map',
                 className='graph-border',
                 style={'height': '120vh'})
     ], width=12), className='mb-3'
 ),
 
-    # Row 4: Sankey (left) | Histogram (right)
+    # Row 6: Sankey (left) | Histogram (right)
     dbc.Row([
         dbc.Col([
             dcc.Checklist(
@@ -149,38 +454,192 @@ dbc.Row(
 
 ], fluid=True)
 
-# define the callback function for nyc_map with inputs determined by borough dropdown and year slider
+def combine_filters(crossfilters, sankey_filter=None):
+    """
+    :param crossfilters: values selected in the crossfilter dropdowns, by column
+    :param sankey_filter: value of the clicked sankey node, by column
+    :return: returns the filters to apply, where a clicked node narrows its column to that node
+    """
+    filters = {col: values for col, values in (crossfilters or {}).items() if values}
+    filters.update(sankey_filter or {})
+    return filters
+
 @app.callback(
-    Output('nyc_map', 'figure'),
-    [Input('year_range_slider', 'value')],
-    [State('active_boroughs', 'data')]
+    Output('crossfilters', 'data'),
+    [Input(f'{col}_filter', 'value') for col in CROSSFILTER_LABELS]
 )
-def update_nyc_map(selected_years, active_boroughs):
+@metrics.instrument('update_crossfilters')
+def update_crossfilters(*selected_values):
+    """
+    :param selected_values: values chosen in each crossfilter dropdown, in the order of CROSSFILTER_LABELS
+    :return: updates the crossfilters store with the non-empty selections
+    """
+    return {col: values for col, values in zip(CROSSFILTER_LABELS, selected_values) if values}
+
+@app.callback(
+    Output('sankey_filter', 'data'),
+    [Input('sankey_diagram', 'clickData')],
+    [State('sankey_columns_checklist', 'value'),
+    State('sankey_filter', 'data')]
+)
+@metrics.instrument('update_sankey_filter')
+def update_sankey_filter(click_data, selected_columns, current_filter):
+    """
+    :param click_data: point clicked on the sankey diagram
+    :param selected_columns: columns the sankey is drawn with
+    :param current_filter: crossfilter set by the previously clicked node
+    :return: updates the sankey crossfilter to the clicked node, or clears it when the same node is clicked again
+    """
+    point = (click_data or {}).get('points', [{}])[0]
+    label = point.get('label')
+
+    # links have no label of their own, and only indexed columns can crossfilter
+    for col in selected_columns:
+        if col in CROSSFILTER_COLUMNS and label in index.values(col):
+            return {} if current_filter == {col: [label]} else {col: [label]}
+
+    return current_filter
+
+def use_aggregates(selected_years):
+    """
+    :param selected_years: years chosen through dashboard slider
+    :return: returns True if summary views should come from aggregate counts: in aggregate mode, or when the
+             years reach back before the rows kept resident by --memory-budget
+    """
+    return args.aggregate or (aggregate_before is not None and selected_years[0] < aggregate_before)
+
+def view_source(selected_years, boroughs, approximate=True):
     """
     :param selected_years: years chosen through dashboard slider
-    :return: updates the nyc_map based on dashboard inputs
+    :param boroughs: boroughs shown in the view
+    :param approximate: allow drawing from the stratified sample
+    :return: returns the df, bitmap index and weight column to draw the view from, the sample when the exact
+             view would cover more than --approximate-above rows
+    """
+    if approximate and sample is not None and \
+            sample.count(selected_years[0], selected_years[1], boroughs) > args.approximate_above:
+        return sample.df, sample.index, WEIGHT_COLUMN
+    return df, index, None
+
+def draw_nyc_map(selected_years, filters, map_state, approximate=True):
+    """
+    :param selected_years: years chosen through dashboard slider
+    :param filters: crossfilters to apply
+    :param map_state: year range, filters, source and trace names of the map currently shown
+    :param approximate: allow drawing from the stratified sample
+    :return: returns the map figure, or a patch of the current map when possible, and the new map state
     """
     all_boroughs = df['borough'].dropna().unique().tolist()
-    return nd.generate_nyc_map(df, 'latitude', 'longitude', yr_start=selected_years[0],
-                            yr_end=selected_years[1], boroughs=all_boroughs)
+    source_df, source_index, weight = view_source(selected_years, all_boroughs, approximate)
+    state = {'layer': 'points', 'years': selected_years, 'filters': filters, 'sampled': weight is not None}
+
+    # only send the changed points and annotation texts once a map has been drawn
+    if map_state:
+        # points can only be appended for added years while the other filters and the source stay the same
+        same_rows = map_state.get('filters') == filters and map_state.get('sampled') == state['sampled']
+        patch, traces = nd.generate_nyc_map_patch(source_df, 'latitude', 'longitude', yr_start=selected_years[0],
+                                                  yr_end=selected_years[1], boroughs=all_boroughs,
+                                                  previous_years=map_state['years'] if same_rows else None,
+                                                  previous_traces=map_state['traces'],
+                                                  filters=filters, index=source_index, weight=weight)
+        if patch is not None:
+            return patch, dict(state, traces=traces)
+
+    fig = nd.generate_nyc_map(source_df, 'latitude', 'longitude', yr_start=selected_years[0],
+                            yr_end=selected_years[1], boroughs=all_boroughs, filters=filters, index=source_index,
+                            weight=weight)
+    return fig, dict(state, traces=[trace.name for trace in fig.data])
+
+# define the callback function for nyc_map with inputs determined by borough dropdown and year slider
+@app.callback(
+    [Output('nyc_map', 'figure'),
+        Output('nyc_map_state', 'data'),
+        Output('nyc_map_exact', 'data')],
+    [Input('year_range_slider', 'value'),
+        Input('crossfilters', 'data'),
+        Input('sankey_filter', 'data'),
+        Input('map_layer', 'value'),
+        Input('density_weight', 'value')],
+    [State('nyc_map_state', 'data')]
+)
+@metrics.instrument('update_nyc_map')
+def update_nyc_map(selected_years, crossfilters, sankey_filter, map_layer, density_weight, map_state):
+    """
+    :param selected_years: years chosen through dashboard slider
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_filter: value of the clicked sankey node
+    :param map_layer: 'points' to plot each collision, 'density' to draw the density grid
+    :param density_weight: what the density layer counts, collisions, injuries or fatalities
+    :param map_state: layer, year range, filters, source and trace names of the map currently shown,
+                      None before the first draw
+    :return: updates the nyc_map based on dashboard inputs, from the sample first for views over many rows
+    """
+    filters = combine_filters(crossfilters, sankey_filter)
+
+    # the density layer sums precomputed grids, and only bins the matching rows when other filters are set
+    if map_layer == 'density':
+        all_boroughs = df['borough'].dropna().unique().tolist()
+        positions = index.rows(index.query(selected_years[0], selected_years[1], all_boroughs, filters)) \
+            if filters else None
+        fig = nd.generate_density_map(density, yr_start=selected_years[0], yr_end=selected_years[1],
+                                      boroughs=all_boroughs, weight=density_weight, positions=positions,
+                                      patch=bool(map_state) and map_state.get('layer') == 'density')
+        return fig, {'layer': 'density', 'traces': []}, no_update
+
+    # a density map is replaced by a whole new point map
+    points_state = map_state if map_state and map_state.get('layer') == 'points' else None
+    fig, state = draw_nyc_map(selected_years, filters, points_state)
+
+    # a sampled map is redrawn exactly by refine_nyc_map right after it is shown, an exact one leaves the
+    # store alone so refine_nyc_map isn't triggered
+    return fig, state, {'years': selected_years, 'filters': filters} if state['sampled'] else no_update
+
+@app.callback(
+    [Output('nyc_map', 'figure', allow_duplicate=True),
+        Output('nyc_map_state', 'data', allow_duplicate=True)],
+    [Input('nyc_map_exact', 'data')],
+    [State('nyc_map_state', 'data'),
+    State('year_range_slider', 'value'),
+    State('crossfilters', 'data'),
+    State('sankey_filter', 'data'),
+    State('map_layer', 'value')],
+    prevent_initial_call=True
+)
+@metrics.instrument('refine_nyc_map')
+def refine_nyc_map(pending, map_state, selected_years, crossfilters, sankey_filter, map_layer):
+    """
+    :param pending: view the last sampled map was drawn for, only set when a sampled map is shown
+    :param map_state: year range, filters, source and trace names of the map currently shown
+    :param selected_years: years chosen through dashboard slider
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_filter: value of the clicked sankey node
+    :param map_layer: layer currently selected
+    :return: replaces the sampled map with the exact one, unless the view has changed since
+    """
+    filters = combine_filters(crossfilters, sankey_filter)
+    if map_layer != 'points' or pending != {'years': selected_years, 'filters': filters}:
+        return no_update, no_update
+
+    return draw_nyc_map(selected_years, filters, map_state, approximate=False)
 
 @app.callback(
     Output('active_boroughs', 'data'),
     [Input('nyc_map', 'restyleData')],
     [State('active_boroughs', 'data'),
-    State('nyc_map', 'figure')]
+    State('nyc_map_state', 'data')]
 )
-def update_active_boroughs(restyle_data, current_boroughs, figure):
+@metrics.instrument('update_active_boroughs')
+def update_active_boroughs(restyle_data, current_boroughs, map_state):
     if not restyle_data or 'visible' not in restyle_data[0]:
         return current_boroughs
 
     visible = restyle_data[0]['visible']
     indices = restyle_data[1]
-    traces = figure['data']
+    traces = map_state['traces']
 
     active = current_boroughs.copy()
     for j, i in enumerate(indices):
-        name = traces[i]['name']
+        name = traces[i]
         if visible[j] == 'legendonly' or visible[j] is False:
             active = [b for b in active if b != name]
         elif name not in active:
@@ -191,22 +650,33 @@ def update_active_boroughs(restyle_data, current_boroughs, figure):
 # define the callback function for sankey_diagram
 # with inputs determined by borough dropdown, year slider, and sankey columns checklist
 @app.callback(
-    Output('sankey_diagram', 'figure'),
+    [Output('sankey_diagram', 'figure'),
+        Output('sankey_state', 'data')],
     [Input('year_range_slider', 'value'),
         Input('sankey_columns_checklist', 'value'),
-        Input('active_boroughs', 'data')]
+        Input('active_boroughs', 'data'),
+        Input('crossfilters', 'data')],
+    [State('sankey_state', 'data')]
 )
 # define a function to actively update the histogram based on selected boroughs and years
-def update_sankey_diagram(selected_years, selected_columns, active_boroughs):
+@metrics.instrument('update_sankey_diagram')
+def update_sankey_diagram(selected_years, selected_columns, active_boroughs, crossfilters, sankey_state):
     """
     :param selected_years: years chosen through dashboard slider
     :param selected_columns: columns selected for Sankey diagram
     :param active_boroughs: currently toggled boroughs
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_state: columns the current sankey was drawn with, None before the first draw
     :return: updates the sankey_diagram based on dashboard inputs
     """
 
+    # the figure only changes shape when the checklist changes, other inputs just patch its links
+    patch = sankey_state == selected_columns
+
     # account for if less than two variables are selected and display text asking to select more
     if len(selected_columns) < 2:
+        if patch:
+            return no_update, no_update  # the message is already shown
         return {
             'data': [],
             'layout': {
@@ -218,32 +688,137 @@ def update_sankey_diagram(selected_years, selected_columns, active_boroughs):
                 'xaxis': {'visible': False},
                 'yaxis': {'visible': False}
             }
-        }
+        }, selected_columns
     else:
 
+        # the sankey's own node clicks only crossfilter the other charts
+        filters = combine_filters(crossfilters)
+
+        # in aggregate mode, or for years left out by --memory-budget, build the sankey from server-side counts
+        # when they are available, grouped by the filtered columns too so the counts can be filtered by them
+        if use_aggregates(selected_years):
+            counts = api.fetch_aggregate(selected_columns + [col for col in filters if col not in selected_columns])
+            if counts is not None:
+                return nd.generate_sankey_from_counts(counts, cols=selected_columns,
+                                                      yr_start=selected_years[0], yr_end=selected_years[1],
+                                                      boroughs=active_boroughs, patch=patch,
+                                                      filters=filters), selected_columns
+
         # return the generate sankey function with new inputs
         return nd.generate_sankey(df, cols=selected_columns,
                                     yr_start=selected_years[0], yr_end=selected_years[1],
-                                    boroughs=active_boroughs)
+                                    boroughs=active_boroughs, patch=patch,
+                                    filters=filters, index=index), selected_columns
+
+def draw_histogram(selected_years, active_boroughs, filters, histogram_state, approximate=True):
+    """
+    :param selected_years: years chosen through dashboard slider
+    :param active_boroughs: currently toggled boroughs
+    :param filters: crossfilters to apply
+    :param histogram_state: 'counts', 'rows' or 'sampled' depending on how the current histogram was built
+    :param approximate: allow drawing from the stratified sample
+    :return: returns the histogram figure, or a patch of the current histogram when possible, and its new state
+    """
+
+    # in aggregate mode, or for years left out by --memory-budget, build the histogram from server-side counts
+    # when they are available
+    if use_aggregates(selected_years):
+        counts = {col: api.fetch_aggregate([col] + list(filters)) for col in HIST_COLUMNS}
+        if all(c is not None for c in counts.values()):
+            return nd.generate_hist_from_counts(counts, cols=HIST_COLUMNS,
+                                                yr_start=selected_years[0], yr_end=selected_years[1],
+                                                boroughs=active_boroughs, patch=histogram_state == 'counts',
+                                                filters=filters), 'counts'
+
+    source_df, source_index, weight = view_source(selected_years, active_boroughs, approximate)
+    source = 'sampled' if weight else 'rows'
+
+    # return the generate histogram function with new inputs
+    return nd.generate_hist(source_df, cols=HIST_COLUMNS,
+                            yr_start=selected_years[0], yr_end=selected_years[1],
+                            boroughs=active_boroughs, patch=histogram_state == source,
+                            filters=filters, index=source_index, weight=weight), source
+
+@app.callback(
+    [Output('export_csv', 'href'),
+        Output('export_parquet', 'href')],
+    [Input('year_range_slider', 'value'),
+        Input('active_boroughs', 'data'),
+        Input('crossfilters', 'data'),
+        Input('sankey_filter', 'data')]
+)
+@metrics.instrument('update_export_links')
+def update_export_links(selected_years, active_boroughs, crossfilters, sankey_filter):
+    """
+    :param selected_years: years chosen through dashboard slider
+    :param active_boroughs: currently toggled boroughs
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_filter: value of the clicked sankey node
+    :return: updates the download links to export the rows the histogram is drawn from
+    """
+    query = {'yr_start': selected_years[0], 'yr_end': selected_years[1], 'borough': active_boroughs,
+             **combine_filters(crossfilters, sankey_filter)}
+    return [f"{app.get_relative_path('/export')}?{urlencode(dict(query, format=fmt), doseq=True)}"
+            for fmt in ('csv', 'parquet')]
 
 # define the callback function for histogram with inputs determined by borough dropdown and year slider
 @app.callback(
-    Output('histogram', 'figure'),
+    [Output('histogram', 'figure'),
+        Output('histogram_state', 'data'),
+        Output('histogram_exact', 'data')],
     [Input('year_range_slider', 'value'),
-        Input('active_boroughs', 'data')]
+        Input('active_boroughs', 'data'),
+        Input('crossfilters', 'data'),
+        Input('sankey_filter', 'data')],
+    [State('histogram_state', 'data')]
 )
 # define a function to actively update the histogram based on selected boroughs and years
-def update_histogram(selected_years, active_boroughs):
+@metrics.instrument('update_histogram')
+def update_histogram(selected_years, active_boroughs, crossfilters, sankey_filter, histogram_state):
     """
     :param selected_years:
     :param active_boroughs: currently toggled boroughs
-    :return: updates the histogram based on dashboard inputs
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_filter: value of the clicked sankey node
+    :param histogram_state: 'counts', 'rows' or 'sampled' depending on how the current histogram was built,
+                            None before the first draw
+    :return: updates the histogram based on dashboard inputs, from the sample first for views over many rows
     """
+    filters = combine_filters(crossfilters, sankey_filter)
+    fig, state = draw_histogram(selected_years, active_boroughs, filters, histogram_state)
 
-    # return the generate histogram function with new inputs
-    return nd.generate_hist(df, cols=['number_of_persons_injured', 'number_of_persons_killed'],
-                            yr_start=selected_years[0], yr_end=selected_years[1],
-                            boroughs=active_boroughs)
+    # a sampled histogram is redrawn exactly by refine_histogram right after it is shown, an exact one leaves
+    # the store alone so refine_histogram isn't triggered
+    pending = {'years': selected_years, 'boroughs': active_boroughs, 'filters': filters}
+    return fig, state, pending if state == 'sampled' else no_update
+
+@app.callback(
+    [Output('histogram', 'figure', allow_duplicate=True),
+        Output('histogram_state', 'data', allow_duplicate=True)],
+    [Input('histogram_exact', 'data')],
+    [State('histogram_state', 'data'),
+    State('year_range_slider', 'value'),
+    State('active_boroughs', 'data'),
+    State('crossfilters', 'data'),
+    State('sankey_filter', 'data')],
+    prevent_initial_call=True
+)
+@metrics.instrument('refine_histogram')
+def refine_histogram(pending, histogram_state, selected_years, active_boroughs, crossfilters, sankey_filter):
+    """
+    :param pending: view the last sampled histogram was drawn for, only set when a sampled histogram is shown
+    :param histogram_state: how the current histogram was built
+    :param selected_years: years chosen through dashboard slider
+    :param active_boroughs: currently toggled boroughs
+    :param crossfilters: values selected in the crossfilter dropdowns
+    :param sankey_filter: value of the clicked sankey node
+    :return: replaces the sampled histogram with the exact one, unless the view has changed since
+    """
+    filters = combine_filters(crossfilters, sankey_filter)
+    if pending != {'years': selected_years, 'boroughs': active_boroughs, 'filters': filters}:
+        return no_update, no_update
+
+    return draw_histogram(selected_years, active_boroughs, filters, histogram_state, approximate=False)
 
 if __name__ == "__main__":
     app.run(debug=args.debug, port=args.port, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,114 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from bitmap_index import BitmapIndex, CROSSFILTER_COLUMNS
+from columnar_store import row_bytes
+from density_grid import DENSITY_WEIGHTS
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# share of the budget left for what callbacks allocate while filtering and drawing
+HEADROOM = 0.2
+
+# loading the rows and building the index, sample and density grid over them allocates temporary arrays, so
+# startup peaks at about this many times the resident cost of the rows (measured on 1M synthetic rows)
+STARTUP_PEAK_FACTOR = 3.5
+
+# rows read to estimate the cost of a row
+ESTIMATE_ROWS = 20_000
+
+# rows of the parquet cache read at a time
+BATCH_ROWS = 100_000
+
+# rows kept resident however small the budget, below this the dashboard isn't worth drawing
+MIN_ROWS = 10_000
+
+
+def process_rss():
+    """
+    :return: returns the memory this process currently has resident in bytes, its peak so far where the
+             current figure isn't available, 0 where neither can be measured
+    """
+    try:
+        # the second field of statm is the resident size in pages
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def estimate_row_bytes(rows, columns=None):
+    """
+    :param rows: a few thousand cleaned rows representative of the dataset
+    :param columns: crossfilter columns the bitmap index is built over
+    :return: returns the bytes each resident row costs: its compacted columns, its codes and bits in the
+             BitmapIndex and its cell and weights in the DensityGrid
+    """
+    index = BitmapIndex(rows, columns=columns or CROSSFILTER_COLUMNS)
+    index_bytes = sum(codes.itemsize for codes, _ in index.codes.values()) + \
+        sum(len(bitmaps) for bitmaps in index.bitmaps.values()) / 8
+    density_bytes = np.dtype(np.int32).itemsize + \
+        np.dtype(np.float32).itemsize * sum(col is not None for col in DENSITY_WEIGHTS.values())
+    return row_bytes(rows) + index_bytes + density_bytes
+
+
+def rows_within_budget(budget_bytes, row_bytes_estimate, used_bytes=0, headroom=HEADROOM,
+                       peak_factor=STARTUP_PEAK_FACTOR):
+    """
+    :param budget_bytes: memory the whole process may use
+    :param row_bytes_estimate: bytes per resident row, from estimate_row_bytes
+    :param used_bytes: memory already in use before any rows are loaded
+    :param headroom: share of the budget kept free for callbacks
+    :param peak_factor: ratio of the startup peak to the resident cost of the rows
+    :return: returns the number of rows that can be kept resident without startup going over the budget,
+             at least MIN_ROWS
+    """
+    available = budget_bytes * (1 - headroom) - used_bytes
+    return max(int(available / (row_bytes_estimate * peak_factor)), MIN_ROWS)
+
+
+def resident_years(year_counts, max_rows):
+    """
+    :param year_counts: Series of row counts indexed by year
+    :param max_rows: number of rows that fit in the budget
+    :return: returns the first year kept resident and the number of rows to keep. Whole years are kept,
+             newest first, and when not even the newest year fits only its most recent max_rows rows are
+    """
+    counts = year_counts.sort_index(ascending=False)
+    kept = counts.cumsum() <= max_rows
+    if not kept.iloc[0]:
+        return int(counts.index[0]), max_rows
+    return int(counts.index[kept.to_numpy()].min()), int(counts[kept].sum())
+
+
+def read_parquet_years(path, first_year, batch_rows=BATCH_ROWS):
+    """
+    :param path: parquet cache of the cleaned dataset
+    :param first_year: first year to read
+    :param batch_rows: rows read at a time
+    :return: returns the rows of first_year and after, filtered a batch at a time with the label columns read
+             as dictionaries, so neither older years nor a python string per label are ever held in memory
+    """
+    schema = pq.read_schema(path)
+    labels = [field.name for field in schema if pa.types.is_string(field.type) or
+              pa.types.is_large_string(field.type)]
+    parquet = pq.ParquetFile(path, read_dictionary=labels)
+
+    cutoff = pa.scalar(pd.Timestamp(first_year, 1, 1), type=schema.field('crash_date').type)
+    batches = [batch.filter(pc.greater_equal(batch['crash_date'], cutoff))
+               for batch in parquet.iter_batches(batch_size=batch_rows)]
+    return pa.Table.from_batches(batches, schema=parquet.schema_arrow).to_pandas()
@@ -0,0 +1,264 @@
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+# optional, gives much more readable profiles than cProfile when installed
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# per-thread state so a callback can hand its duration to the request hooks around it
+_local = threading.local()
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """
+    :param label_names: names of the labels
+    :param label_values: values of the labels, same order as label_names
+    :param extra: optional (name, value) pair appended after the labels, e.g. ('le', '0.5')
+    :return: returns the labels formatted for the Prometheus text format, e.g. {stage="filter"}
+    """
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, description, label_names, buckets):
+        """
+        :description: a Prometheus histogram with one set of buckets per label combination
+        :param name: metric name
+        :param description: help text shown in the exposition
+        :param label_names: names of the labels every observation is tagged with
+        :param buckets: upper bounds of the buckets, +Inf is added automatically
+        """
+
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        :param value: observed value
+        :param labels: label values for this observation
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.series[key] = (counts, total + value)
+
+    def render(self):
+        """
+        :return: returns the histogram in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total) in sorted(self.series.items()):
+                bounds = [f'{bound:g}' for bound in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, ("le", bound))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {counts[-1]}')
+        return '\n'.join(lines)
+
+
+class Counter:
+    def __init__(self, name, description, label_names):
+        """
+        :description: a Prometheus counter with one value per label combination
+        :param name: metric name, should end in _total
+        :param description: help text shown in the exposition
+        :param label_names: names of the labels every increment is tagged with
+        """
+
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        """
+        :return: returns the counter in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{_format_labels(self.label_names, key)} {value}')
+        return '\n'.join(lines)
+
+
+CALLBACK_SECONDS = Histogram('dashboard_callback_seconds', 'Time spent inside each Dash callback.',
+                             ['callback'], SECONDS_BUCKETS)
+STAGE_SECONDS = Histogram('dashboard_stage_seconds', 'Time spent in each stage of a figure generator.',
+                          ['function', 'stage'], SECONDS_BUCKETS)
+FILTERED_ROWS = Histogram('dashboard_filtered_rows', 'Rows left after filtering, per figure generator.',
+                          ['function'], ROWS_BUCKETS)
+RESPONSE_BYTES = Histogram('dashboard_response_bytes', 'Size of the serialized callback response.',
+                           ['output'], BYTES_BUCKETS)
+SERIALIZE_SECONDS = Histogram('dashboard_serialize_seconds',
+                              'Request time spent outside the callback, mostly JSON serialization.',
+                              ['output'], SECONDS_BUCKETS)
+CACHE_REQUESTS = Counter('dashboard_cache_requests_total', 'Cache lookups by cache and result.',
+                         ['cache', 'result'])
+
+REGISTRY = [CALLBACK_SECONDS, STAGE_SECONDS, FILTERED_ROWS, RESPONSE_BYTES, SERIALIZE_SECONDS, CACHE_REQUESTS]
+
+# profiling settings, set by register
+_profile = {'sample_rate': 0.0, 'slow_ms': 500, 'dir': 'profiles'}
+
+
+@contextmanager
+def stage(function, name):
+    """
+    :description: times the wrapped block as one stage of a figure generator
+    :param function: name of the generator, e.g. 'generate_sankey'
+    :param name: name of the stage, e.g. 'filter'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, function=function, stage=name)
+
+
+def observe_rows(function, rows):
+    """
+    :param function: name of the generator that filtered the data
+    :param rows: number of rows left after filtering
+    """
+    FILTERED_ROWS.observe(rows, function=function)
+
+
+def record_cache(cache, hit):
+    """
+    :param cache: name of the cache, e.g. 'parquet'
+    :param hit: whether the lookup was a hit
+    """
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def _run_profiled(fn, name, args, kwargs):
+    """
+    :description: runs fn under a profiler and keeps the profile only if the call was slow
+    :return: returns fn's result and its duration in seconds
+    """
+    if Profiler:
+        profiler = Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        if Profiler:
+            profiler.stop()
+        else:
+            profiler.disable()
+
+    if elapsed * 1000 >= _profile['slow_ms']:
+        os.makedirs(_profile['dir'], exist_ok=True)
+        stem = os.path.join(_profile['dir'], f'{name}_{int(time.time() * 1000)}')
+        if Profiler:
+            with open(f'{stem}.html', 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.dump_stats(f'{stem}.prof')
+        print(f'Slow callback {name} ({elapsed * 1000:.0f} ms), profile saved to {stem}')
+
+    return result, elapsed
+
+
+def instrument(name):
+    """
+    :param name: name the callback is reported under
+    :return: returns a decorator that times the callback and, if enabled, samples it with a profiler
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profile['sample_rate'] and random.random() < _profile['sample_rate']:
+                result, elapsed = _run_profiled(fn, name, args, kwargs)
+            else:
+                start = time.perf_counter()
+                try:
+                    result = fn(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+            CALLBACK_SECONDS.observe(elapsed, callback=name)
+            _local.callback_seconds = getattr(_local, 'callback_seconds', 0.0) + elapsed
+            return result
+        return wrapper
+    return decorator
+
+
+def render():
+    """
+    :return: returns every metric in the Prometheus text format
+    """
+    return '\n\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def register(server, profile_sample_rate=0.0, profile_slow_ms=500, profile_dir='profiles'):
+    """
+    :description: adds the /metrics route and the request hooks that measure callback payloads
+    :param server: the Flask server behind the Dash app (app.server)
+    :param profile_sample_rate: fraction of callbacks to run under a profiler
+    :param profile_slow_ms: profiles of callbacks faster than this are discarded
+    :param profile_dir: folder slow callback profiles are written to
+    """
+    _profile.update(sample_rate=profile_sample_rate, slow_ms=profile_slow_ms, dir=profile_dir)
+
+    @server.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+        _local.callback_seconds = 0.0
+
+    @server.after_request
+    def _record_response(response):
+        # only Dash callback requests carry a figure payload
+        if not request.path.endswith('_dash-update-component') or response.direct_passthrough:
+            return response
+
+        body = request.get_json(silent=True) or {}
+        output = body.get('output', 'unknown')
+        RESPONSE_BYTES.observe(response.calculate_content_length() or 0, output=output)
+
+        total = time.perf_counter() - g.get('metrics_start', time.perf_counter())
+        SERIALIZE_SECONDS.observe(max(total - _local.callback_seconds, 0.0), output=output)
+        return response
+
+    @server.route('/metrics')
+    def _metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
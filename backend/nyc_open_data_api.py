@@ -1,23 +1,41 @@
+import hashlib
+import itertools
+import json
+import os
+
 import requests
 import pandas as pd
 from io import StringIO
+from urllib.parse import urlparse
 
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+import metrics
+
+# columns every aggregate query is grouped by, so one cached query serves any year range and borough selection
+AGGREGATE_KEYS = ['year', 'borough']
+
+# groups requested per aggregate query, larger results are paged through
+AGGREGATE_PAGE_ROWS = 1_000_000
+
 # defined a class to manage NYC Open Data online API and process queried data
 # provides access to up-to-date data as it can access the current state of the online API
 class NYCOpenDataAPI:
-    def __init__(self, url, key):
+    def __init__(self, url, key, cache_dir=None):
         """
         :description: initializes class and sets url and key as class variables
         :param url: given NYC Open Data API url
         :param key: given personal API key
+        :param cache_dir: folder to persist aggregate query results in, memory only if None
         """
 
         self.url = url
         self.key = key
 
+        # aggregate query results, keyed by a hash of the query params
+        self.cache_dir = cache_dir
+        self._aggregate_cache = {}
 
         self.session = requests.Session()
         retry_strategy = Retry(
@@ -29,19 +47,51 @@ class NYCOpenDataAPI:
         self.session.mount('https://', adapter)
         self.session.mount('http://', adapter)
 
-    def _fetch_response(self, columns, limit, yr_start, yr_end):
+        # the CSV compresses several times over, and requests decompresses it transparently
+        self.session.headers['Accept-Encoding'] = 'gzip'
+
+    def _row_params(self, columns, limit, yr_start, yr_end, offset=0):
         """
         :param columns: specified columns to pull from the online API
         :param limit: specified limit of how many rows to pull
         :param yr_start: specified start year of requested data
         :param yr_end: specified end year of requested data
-        :return: returns the response object from the API request, or None if the request fails
+        :param offset: number of rows to skip, used to page through large pulls
+        :return: returns the SODA params of a row query
         """
 
         # join columns as string separated by commas
         if columns:
             columns = ",".join(columns)
 
+        return {'$$app_token': self.key,
+                '$select': columns,
+                '$limit': limit,
+                '$offset': offset,
+                '$order': 'CRASH_DATE DESC, :id',  # :id keeps the order stable across pages
+                '$where': self._where_clause(yr_start, yr_end)
+                }
+
+    def _fetch_response(self, columns, limit, yr_start, yr_end, offset=0):
+        """
+        :param columns: specified columns to pull from the online API
+        :param limit: specified limit of how many rows to pull
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :param offset: number of rows to skip, used to page through large pulls
+        :return: returns the response object from the API request, or None if the request fails
+        """
+
+        return self._get(self._row_params(columns, limit, yr_start, yr_end, offset))
+
+    @staticmethod
+    def _where_clause(yr_start, yr_end):
+        """
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :return: returns the $where clause shared by row and aggregate queries
+        """
+
         # set where conditions to specify year conditions
         where_condition_year = (f"CRASH_DATE >= '{yr_start}-01-01T00:00:00.000' AND CRASH_DATE <= '{yr_end}"
                                 "-12-31T23:59:59.999'")
@@ -50,33 +100,45 @@ class NYCOpenDataAPI:
         where_condition_borough = "BOROUGH IS NOT NULL"
         where_condition_street = "ON_STREET_NAME IS NOT NULL"
 
-        params = {'$$app_token': self.key,
-                  '$select': columns,
-                  '$limit': limit,
-                  '$order': 'CRASH_DATE DESC',
-                  '$where': f"{where_condition_year} AND {where_condition_borough} AND {where_condition_street}"
-                  }
+        return f"{where_condition_year} AND {where_condition_borough} AND {where_condition_street}"
+
+    def _get(self, params, url=None, headers=None):
+        """
+        :param params: SODA query params
+        :param url: url to query, the resource url if None
+        :param headers: extra request headers
+        :return: returns the response object from the API request, or None if the request fails
+        """
 
         # attempt to query the API, if unsuccessful print error
         try:
-            response = self.session.get(self.url, params=params, timeout=30)
+            response = self.session.get(url or self.url, params=params, headers=headers, timeout=30)
             response.raise_for_status()
             return response
         except Exception as e:
             print("Error while fetching the response:", e)
             return None
 
-    def fetch_data(self, columns=None, limit=1000, yr_start=2000, yr_end=3000):
+    def _fetch_page(self, columns, limit, yr_start, yr_end, offset=0):
         """
         :param columns: specified columns to pull from the online API
         :param limit: specified limit of how many rows to pull
         :param yr_start: specified start year of requested data
         :param yr_end: specified end year of requested data
-        :return: returns a pandas df from the API based on the specified params
+        :param offset: number of rows to skip
+        :return: returns a pandas df of a single API response, or None if the request or parsing fails
         """
 
         # call the _fetch_response function to generate a response
-        response = self._fetch_response(columns, limit, yr_start, yr_end)
+        response = self._fetch_response(columns, limit, yr_start, yr_end, offset)
+        return self._read_csv(response)
+
+    @staticmethod
+    def _read_csv(response):
+        """
+        :param response: response to a row query, or None if the request failed
+        :return: returns a pandas df of the response, or None if there is none or parsing fails
+        """
 
         # make sure response has been generated and read it into a df using pandas
         if response is not None:
@@ -92,6 +154,185 @@ class NYCOpenDataAPI:
             print("Response not generated.")
             return None
 
+    def fetch_data(self, columns=None, limit=1000, yr_start=2000, yr_end=3000, page_size=None):
+        """
+        :param columns: specified columns to pull from the online API
+        :param limit: specified limit of how many rows to pull
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :param page_size: if given, pull the rows in pages of this size using $offset instead of one request
+        :return: returns a pandas df from the API based on the specified params
+        """
+
+        if not page_size or page_size >= limit:
+            return self._fetch_page(columns, limit, yr_start, yr_end)
+
+        # page through the results until the limit is reached or the API runs out of rows
+        pages = []
+        for offset in range(0, limit, page_size):
+            page = self._fetch_page(columns, min(page_size, limit - offset), yr_start, yr_end, offset)
+            if page is None:
+                return None
+            pages.append(page)
+            if len(page) < page_size:
+                break
+
+        return pd.concat(pages, ignore_index=True)
+
+    @property
+    def metadata_url(self):
+        """
+        :return: returns the portal's metadata endpoint for the dataset, e.g. /api/views/h9gi-nx95.json for
+                 /resource/h9gi-nx95.csv
+        """
+        parsed = urlparse(self.url)
+        dataset_id = os.path.splitext(os.path.basename(parsed.path))[0]
+        return f'{parsed.scheme}://{parsed.netloc}/api/views/{dataset_id}.json'
+
+    def rows_updated_at(self):
+        """
+        :return: returns when the dataset's rows last changed, in unix seconds, as reported by the metadata
+                 endpoint, or None if it can't be read
+        """
+
+        response = self._get(None, url=self.metadata_url, headers={'X-App-Token': self.key} if self.key else None)
+        if response is None:
+            return None
+        try:
+            return int(response.json()['rowsUpdatedAt'])
+        except Exception as e:
+            print("Error while reading dataset metadata:", e)
+            return None
+
+    def fetch_data_if_modified(self, validators=None, columns=None, limit=1000, yr_start=2000, yr_end=3000):
+        """
+        :param validators: validators returned by the last call for the same rows, None to fetch unconditionally
+        :param columns: specified columns to pull from the online API
+        :param limit: specified limit of how many rows to pull
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :return: returns (df, validators, modified). The request carries the ETag and Last-Modified of the
+                 last response to the same query, so when the rows haven't changed the API answers 304 without
+                 a body and df is None with modified False. df is None with modified True if the request fails
+        """
+
+        params = self._row_params(columns, limit, yr_start, yr_end)
+        query = {key: value for key, value in params.items() if key != '$$app_token'}
+        query_key = hashlib.sha1(json.dumps([self.url, query], sort_keys=True).encode()).hexdigest()[:16]
+
+        # validators only describe the response to the exact same query
+        headers = {}
+        if validators and validators.get('query') == query_key:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self._get(params, headers=headers)
+        if response is not None and response.status_code == 304:
+            return None, validators, False
+
+        df = self._read_csv(response)
+        if df is None:
+            return None, None, True
+        return df, {'query': query_key,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')}, True
+
+    @staticmethod
+    def build_aggregate_params(group_by, yr_start=2012, yr_end=3000, limit=AGGREGATE_PAGE_ROWS, offset=0):
+        """
+        :param group_by: columns to count collisions by, on top of year and borough
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :param limit: maximum number of groups to return
+        :param offset: number of groups to skip, used to page through queries with more than limit groups
+        :return: returns SODA params for a $select=...,count(*)&$group=... query
+        """
+
+        group_cols = ['borough'] + [col for col in group_by if col != 'borough']
+        select = ['date_extract_y(crash_date) AS year'] + group_cols + ['count(*) AS count']
+
+        return {'$select': ', '.join(select),
+                '$group': ', '.join(['year'] + group_cols),
+                '$where': NYCOpenDataAPI._where_clause(yr_start, yr_end),
+                '$order': ', '.join(['year'] + group_cols),  # a stable order keeps pages from overlapping
+                '$limit': limit,
+                '$offset': offset}
+
+    def _aggregate_cache_path(self, cache_key):
+        return os.path.join(self.cache_dir, f'aggregate_{cache_key}.parquet') if self.cache_dir else None
+
+    def fetch_aggregate(self, group_by, yr_start=2012, yr_end=3000, page_size=AGGREGATE_PAGE_ROWS):
+        """
+        :param group_by: columns to count collisions by, on top of year and borough
+        :param yr_start: specified start year of requested data
+        :param yr_end: specified end year of requested data
+        :param page_size: groups requested at a time, queries with more groups are paged through with $offset
+        :return: returns a df of collision counts per year, borough and group_by column, cleaned like
+                 fetched rows, or None if any request fails
+        """
+
+        # every page of the query shares the cache entry
+        params = {key: value for key, value in self.build_aggregate_params(group_by, yr_start, yr_end).items()
+                  if key not in ('$limit', '$offset')}
+        cache_key = hashlib.sha1(json.dumps([self.url, params], sort_keys=True).encode()).hexdigest()[:16]
+        path = self._aggregate_cache_path(cache_key)
+
+        # check memory first, then disk, before querying the API
+        if cache_key in self._aggregate_cache:
+            metrics.record_cache('aggregate', True)
+            return self._aggregate_cache[cache_key]
+        if path and os.path.exists(path):
+            metrics.record_cache('aggregate', True)
+            counts = pd.read_parquet(path)
+            self._aggregate_cache[cache_key] = counts
+            return counts
+        metrics.record_cache('aggregate', False)
+
+        # page through the groups until a short page, so results are never cut off at the $limit
+        pages = []
+        for offset in itertools.count(0, page_size):
+            page_params = self.build_aggregate_params(group_by, yr_start, yr_end, page_size, offset)
+            response = self._get({'$$app_token': self.key, **page_params})
+            if response is None:
+                print("Response not generated.")
+                return None
+
+            try:
+                page = pd.read_csv(StringIO(response.text))
+            except Exception as e:
+                print("Error while parsing CSV data:", e)
+                return None
+            pages.append(page)
+            if len(page) < page_size:
+                break
+        counts = pd.concat(pages, ignore_index=True)
+
+        # clean labels the same way as fetched rows, then merge any groups that now share a label
+        counts = self.process_strings(counts)
+        if 'crash_time' in counts.columns:
+            counts['crash_time'] = self.convert_time_col_to_ranges(counts, 'crash_time')
+        keys = AGGREGATE_KEYS + [col for col in group_by if col not in AGGREGATE_KEYS]
+        counts = counts.groupby(keys, dropna=False)['count'].sum().reset_index()
+
+        self._aggregate_cache[cache_key] = counts
+        if path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            counts.to_parquet(path)
+        return counts
+
+    def clear_aggregate_cache(self):
+        """
+        :description: drops cached aggregate results from memory and disk
+        """
+
+        self._aggregate_cache.clear()
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('aggregate_') and name.endswith('.parquet'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
     @staticmethod
     def process_strings(df):
         """
@@ -163,3 +404,47 @@ class NYCOpenDataAPI:
             filtered = filtered[filtered['borough'].isin(boroughs)]  # if boroughs are given, filter by them
 
         return filtered
+
+    @staticmethod
+    def crossfilter(df, yr_start, yr_end, boroughs=None, filters=None, index=None):
+        """
+        :param df: given df to filter data by year range, boroughs and other columns
+        :param yr_start: start of year range to filter data by
+        :param yr_end: end of year range to filter data by
+        :param boroughs: specified boroughs to filter data by
+        :param filters: dict mapping column names to the values to keep, empty lists are ignored
+        :param index: BitmapIndex built over df, resolves the filters with bitwise ops when given
+        :return: returns df filtered like filter_by_year_and_borough and further by filters
+        """
+
+        # the index answers every condition at once without scanning the columns
+        if index is not None:
+            return df.iloc[index.rows(index.query(yr_start, yr_end, boroughs, filters))]
+
+        filtered = NYCOpenDataAPI.filter_by_year_and_borough(df, yr_start=yr_start, yr_end=yr_end, boroughs=boroughs)
+        for col, values in (filters or {}).items():
+            if values:
+                filtered = filtered[filtered[col].isin(values)]
+
+        return filtered
+
+    @staticmethod
+    def filter_counts_by_year_and_borough(counts, yr_start, yr_end, boroughs=None, filters=None):
+        """
+        :param counts: df of counts from fetch_aggregate
+        :param yr_start: start of year range to filter counts by
+        :param yr_end: end of year range to filter counts by
+        :param boroughs: specified boroughs to filter counts by
+        :param filters: dict mapping grouped columns to the values to keep, empty lists are ignored
+        :return: returns the counts whose 'year' and 'borough' fall in the specified range and boroughs
+        """
+        mask = (counts['year'] >= yr_start) & (counts['year'] <= yr_end)
+
+        if boroughs:
+            mask &= counts['borough'].isin(boroughs)  # if boroughs are given, filter by them
+
+        for col, values in (filters or {}).items():
+            if values:
+                mask &= counts[col].isin(values)
+
+        return counts[mask]
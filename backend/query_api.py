@@ -0,0 +1,268 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import Response, request
+
+import metrics
+from bitmap_index import CROSSFILTER_COLUMNS
+from export import view_from_args, matching_rows
+
+API_PREFIX = '/api/v1'
+
+# columns counts can be grouped by, and numeric columns histograms can be binned over
+GROUP_COLUMNS = ['year', 'borough', 'on_street_name'] + CROSSFILTER_COLUMNS
+HIST_COLUMNS = ['number_of_persons_injured', 'number_of_persons_killed']
+
+DEFAULT_PAGE_ROWS = 100
+MAX_PAGE_ROWS = 10_000
+
+# number of answers kept, keyed by their ETag
+CACHE_SIZE = 256
+
+
+class QueryError(ValueError):
+    """Raised when a query asks for something the API can't answer, returned as a 400 response."""
+
+
+def dataset_version(df):
+    """
+    :param df: cleaned collision df served by the API
+    :return: returns a short hash identifying the data, so ETags change whenever the dataset does
+    """
+    numeric = df[['crash_date', 'latitude', 'longitude'] + HIST_COLUMNS]
+    return f'{len(df)}-{int(pd.util.hash_pandas_object(numeric, index=False).sum()) & 0xffffffff:08x}'
+
+
+def _column(df, rows, col):
+    """
+    :return: returns col of the rows at positions rows, deriving 'year' from crash_date
+    """
+    if col == 'year':
+        return df['crash_date'].iloc[rows].dt.year
+    return df[col].iloc[rows]
+
+
+def totals(df, rows):
+    """
+    :param df: cleaned collision df
+    :param rows: positions of the matching rows
+    :return: returns the number of collisions and of people injured and killed in them
+    """
+    return {'collisions': len(rows),
+            'persons_injured': int(df['number_of_persons_injured'].iloc[rows].sum()),
+            'persons_killed': int(df['number_of_persons_killed'].iloc[rows].sum())}
+
+
+def group_counts(df, rows, cols, limit=None, index=None):
+    """
+    :param df: cleaned collision df
+    :param rows: positions of the matching rows
+    :param cols: columns to group by, from GROUP_COLUMNS
+    :param limit: number of largest groups to return, all if None
+    :param index: BitmapIndex built over df, counts the groups over its codes when it covers every column
+    :return: returns the collision count of each combination of cols, largest first, like the sankey's links
+    """
+    if index is not None and all(col in index.codes for col in cols):
+        grouped = index.group_counts(rows, cols)
+    else:
+        grouped = pd.DataFrame({col: _column(df, rows, col).to_numpy() for col in cols})\
+            .groupby(cols, observed=True).size().reset_index(name='count')
+    grouped = grouped.sort_values('count', ascending=False, kind='stable')
+    if limit is not None:
+        grouped = grouped.head(limit)
+    return json.loads(grouped.to_json(orient='records'))
+
+
+def histogram_bins(df, rows, col):
+    """
+    :param df: cleaned collision df
+    :param rows: positions of the matching rows
+    :param col: numeric column from HIST_COLUMNS
+    :return: returns the count and percent of collisions for each value of col, like the dashboard histogram
+    """
+    counts = _column(df, rows, col).value_counts().sort_index()
+    total = max(int(counts.sum()), 1)
+    return [{'value': int(value), 'count': int(count), 'percent': 100 * int(count) / total}
+            for value, count in counts.items()]
+
+
+def page_rows(df, rows, after=None, limit=DEFAULT_PAGE_ROWS, fields=None):
+    """
+    :param df: cleaned collision df
+    :param rows: positions of the matching rows, ascending
+    :param after: id of the last row of the previous page, None for the first page
+    :param limit: number of rows per page
+    :param fields: columns to return, all if empty
+    :return: returns the page of rows following after, each with its 'id', and the id to pass as after for the
+             next page (None on the last page). Pages are found by binary search on the ids, so later pages cost
+             the same as the first
+    """
+    start = 0 if after is None else int(np.searchsorted(rows, after, side='right'))
+    page = rows[start:start + limit]
+
+    records = df.iloc[page][fields or list(df.columns)]
+    records.insert(0, 'id', page)
+    data = json.loads(records.to_json(orient='records', date_format='iso'))
+
+    has_more = start + limit < len(rows)
+    return {'data': data, 'next': int(page[-1]) if has_more else None}
+
+
+def _int_arg(args, name, default=None, minimum=0, maximum=None):
+    """
+    :return: returns the integer query argument name, raising QueryError if it isn't one in range
+    """
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise QueryError(f'{name} must be an integer')
+    if value < minimum:
+        raise QueryError(f'{name} must be at least {minimum}')
+    if maximum is not None and value > maximum:
+        raise QueryError(f'{name} must be at most {maximum}')
+    return value
+
+
+def parse_query(endpoint, args, df, yr_min, yr_max, loaded_from=None):
+    """
+    :param endpoint: name of the requested endpoint
+    :param args: query string of the request
+    :param df: cleaned collision df
+    :param yr_min: year range start when the query has none
+    :param yr_max: year range end when the query has none
+    :param loaded_from: first year in df when older ones were left out, earlier year ranges are rejected
+    :return: returns the query's view (year range, boroughs and crossfilters) and the endpoint's own parameters,
+             raising QueryError if any of them can't be answered
+    """
+    try:
+        view = view_from_args(args, yr_min, yr_max, loaded_from)
+    except ValueError as e:
+        raise QueryError(str(e))
+
+    if endpoint == 'counts':
+        cols = args.getlist('group_by')
+        if not cols or any(col not in GROUP_COLUMNS for col in cols):
+            raise QueryError(f"group_by must be one or more of {', '.join(GROUP_COLUMNS)}")
+        return view, {'cols': cols, 'limit': _int_arg(args, 'limit', minimum=1)}
+
+    if endpoint == 'histogram':
+        col = args.get('column')
+        if col not in HIST_COLUMNS:
+            raise QueryError(f"column must be one of {', '.join(HIST_COLUMNS)}")
+        return view, {'col': col}
+
+    if endpoint == 'collisions':
+        fields = args.getlist('fields')
+        if any(field not in df.columns for field in fields):
+            raise QueryError(f"fields must be columns of {', '.join(df.columns)}")
+        return view, {'fields': fields, 'after': _int_arg(args, 'after'),
+                      'limit': _int_arg(args, 'limit', DEFAULT_PAGE_ROWS, minimum=1, maximum=MAX_PAGE_ROWS)}
+
+    return view, {}
+
+
+def _answer(endpoint, params, df, rows, index=None):
+    """
+    :param endpoint: name of the requested endpoint
+    :param params: the endpoint's parameters, from parse_query
+    :param df: cleaned collision df
+    :param rows: positions of the rows matching the query's filters
+    :param index: BitmapIndex built over df
+    :return: returns the JSON-serializable answer to the query
+    """
+    if endpoint == 'totals':
+        return totals(df, rows)
+
+    if endpoint == 'boroughs':
+        counts = group_counts(df, rows, ['borough'], index=index)
+        return {'boroughs': {row['borough']: row['count'] for row in counts}}
+
+    if endpoint == 'counts':
+        return {'group_by': params['cols'],
+                'counts': group_counts(df, rows, params['cols'], limit=params['limit'], index=index)}
+
+    if endpoint == 'histogram':
+        return {'column': params['col'], 'bins': histogram_bins(df, rows, params['col'])}
+
+    # collisions: the matching rows themselves, a page at a time
+    return page_rows(df, rows, after=params['after'], limit=params['limit'], fields=params['fields'])
+
+
+def register(server, df, index=None, loaded_from=None, partial_year=None, prefix=API_PREFIX,
+             cache_size=CACHE_SIZE):
+    """
+    :description: adds the read-only JSON API under prefix. Every endpoint takes the dashboard's filters
+                  (yr_start, yr_end, borough and the crossfilter columns, repeated to OR values):
+                    /totals                  collisions, injuries and fatalities
+                    /boroughs                collisions per borough
+                    /counts?group_by=...     collisions per combination of columns, largest first
+                    /histogram?column=...    collisions per value of a numeric column
+                    /collisions              the matching rows, paginated with limit and after
+                  Answers carry an ETag derived from the dataset and the query, so repeated requests are
+                  answered with 304 before any filtering, and recent answers are cached
+    :param server: the Flask server behind the Dash app (app.server)
+    :param df: cleaned collision df to answer from
+    :param index: BitmapIndex built over df, shared with the dashboard to find the matching rows
+    :param loaded_from: first year in df when --memory-budget left older ones out, queries reaching back before
+                        it get a 400 naming the loaded years instead of incomplete counts
+    :param partial_year: year of which df only holds the most recent rows, answers covering it carry it as
+                         'partial_year'
+    :param prefix: path the endpoints are mounted under
+    :param cache_size: number of answers kept in memory
+    """
+    version = dataset_version(df)
+    yr_min, yr_max = df['crash_date'].min().year, df['crash_date'].max().year
+    if loaded_from is not None:
+        yr_min = loaded_from
+    cache = OrderedDict()
+    lock = threading.Lock()
+
+    def respond(endpoint):
+        # the data never changes while the server runs, so the query alone identifies the answer
+        query = json.dumps(sorted((key, request.args.getlist(key)) for key in request.args))
+        etag = hashlib.sha1(f'{version}{endpoint}{query}'.encode()).hexdigest()[:20]
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        with lock:
+            body = cache.get(etag)
+            if body is not None:
+                cache.move_to_end(etag)
+        metrics.record_cache('api', body is not None)
+
+        if body is None:
+            # only a bad query is the client's fault, anything failing past parsing is left to surface as a 500
+            try:
+                (yr_start, yr_end, boroughs, filters), params = parse_query(endpoint, request.args, df,
+                                                                            yr_min, yr_max, loaded_from)
+            except QueryError as e:
+                return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+
+            rows = matching_rows(df, yr_start, yr_end, boroughs=boroughs, filters=filters, index=index)
+            metrics.observe_rows(f'api_{endpoint}', len(rows))
+            answer = _answer(endpoint, params, df, rows, index)
+            if partial_year is not None and yr_start <= partial_year <= yr_end:
+                answer['partial_year'] = partial_year
+            body = json.dumps(answer)
+
+            with lock:
+                cache[etag] = body
+                while len(cache) > cache_size:
+                    cache.popitem(last=False)
+
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    for endpoint in ('totals', 'boroughs', 'counts', 'histogram', 'collisions'):
+        server.add_url_rule(f'{prefix}/{endpoint}', f'api_{endpoint}',
+                            lambda endpoint=endpoint: respond(endpoint))
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from bitmap_index import BitmapIndex
+
+# column of the sample holding how many rows of the full dataset each sampled row stands for
+WEIGHT_COLUMN = 'weight'
+
+
+class StratifiedSample:
+    def __init__(self, df, per_stratum=150, columns=None, seed=0):
+        """
+        :description: keeps a fixed-size uniform sample of the rows of every (year, borough) stratum, so views
+                      over any year range touch at most per_stratum rows per year and borough
+        :param df: cleaned collision df, sampled once at ingest
+        :param per_stratum: number of rows kept from each stratum, smaller strata are kept whole
+        :param columns: crossfilter columns to index the sample on, see BitmapIndex
+        :param seed: seed of the random sample
+        """
+
+        year = df['crash_date'].dt.year.to_numpy()
+        strata = df.groupby([year, df['borough'].to_numpy()], dropna=False, sort=False).ngroup().to_numpy()
+        sizes = np.bincount(strata)
+
+        # shuffle the rows, then keep the first per_stratum of each stratum, which gives every row of a
+        # stratum the same chance of being kept, like a reservoir sample of that size
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((rng.random(len(df)), strata))
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        rank = np.arange(len(df)) - np.repeat(starts, sizes)
+        positions = np.sort(order[rank < per_stratum])
+
+        kept = np.minimum(sizes, per_stratum)
+        self.n_rows = len(df)
+        self.positions = positions
+        self.df = df.iloc[positions].reset_index(drop=True)
+        self.df[WEIGHT_COLUMN] = (sizes / np.maximum(kept, 1))[strata[positions]]
+        self.index = BitmapIndex(self.df, columns=columns)
+
+        # exact row counts per stratum, which answer year and borough filters without the sample
+        self.strata = pd.DataFrame({'year': year, 'borough': df['borough'].to_numpy()})\
+            .groupby(['year', 'borough'], dropna=False).size().rename('rows').reset_index()
+
+    def count(self, yr_start, yr_end, boroughs=None):
+        """
+        :param yr_start: start of year range
+        :param yr_end: end of year range
+        :param boroughs: boroughs to count, all if empty
+        :return: returns the exact number of rows of the full dataset in the year range and boroughs
+        """
+        mask = (self.strata['year'] >= yr_start) & (self.strata['year'] <= yr_end)
+        if boroughs:
+            mask &= self.strata['borough'].isin(boroughs)
+        return int(self.strata.loc[mask, 'rows'].sum())
@@ -0,0 +1,151 @@
+"""
+Shared fixtures and options for the offline benchmark suite.
+
+Usage (from project root):
+    pytest tests/benchmarks                                   # 100k rows
+    pytest tests/benchmarks --bench-rows 100k,1m,5m           # every size
+    pytest tests/benchmarks --bench-save-baseline              # record peak memory / figure size
+    pytest tests/benchmarks --bench-check-baseline --bench-max-regression 10
+
+Timing regressions use pytest-benchmark's own comparison, e.g.
+    pytest tests/benchmarks --benchmark-autosave
+    pytest tests/benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+import json
+import os
+import sys
+import tracemalloc
+
+import plotly.graph_objects as go
+import pytest
+
+# Add project root, tests/ and backend/ to path so imports work from the tests/benchmarks folder
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from synthetic import generate_collisions, clean_collisions
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+_raw_cache = {}
+_clean_cache = {}
+_results = {}
+
+
+def _parse_rows(value):
+    """
+    :param value: comma separated row counts, accepting k/m suffixes (e.g. '100k,1m,5m')
+    :return: returns a list of integer row counts
+    """
+    sizes = []
+    for item in value.split(','):
+        item = item.strip().lower()
+        multiplier = {'k': 1_000, 'm': 1_000_000}.get(item[-1:], 1)
+        sizes.append(int(float(item.rstrip('km')) * multiplier))
+    return sizes
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('collision benchmarks')
+    group.addoption('--bench-rows', default='100k',
+                    help='Comma separated synthetic dataset sizes, e.g. 100k,1m,5m')
+    group.addoption('--bench-rounds', type=int, default=3,
+                    help='Timed rounds per benchmark')
+    group.addoption('--bench-baseline', default=DEFAULT_BASELINE,
+                    help='JSON file holding peak memory and figure size baselines')
+    group.addoption('--bench-save-baseline', action='store_true', default=False,
+                    help='Write this run\'s peak memory and figure sizes to the baseline file')
+    group.addoption('--bench-check-baseline', action='store_true', default=False,
+                    help='Fail when peak memory or figure size regress past --bench-max-regression')
+    group.addoption('--bench-max-regression', type=float, default=10.0,
+                    help='Allowed growth over the baseline, in percent')
+
+
+def pytest_generate_tests(metafunc):
+    if 'n_rows' in metafunc.fixturenames:
+        sizes = _parse_rows(metafunc.config.getoption('--bench-rows'))
+        metafunc.parametrize('n_rows', sizes, ids=[f'{n:_}rows' for n in sizes], scope='session')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    if not config.getoption('--bench-save-baseline', default=False) or not _results:
+        return
+
+    path = config.getoption('--bench-baseline')
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    baseline.update(_results)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture(scope='session')
+def raw_df(n_rows):
+    """Raw synthetic rows, as they would come back from fetch_data."""
+    if n_rows not in _raw_cache:
+        _raw_cache[n_rows] = generate_collisions(n_rows)
+    return _raw_cache[n_rows]
+
+
+@pytest.fixture(scope='session')
+def clean_df(n_rows, raw_df):
+    """Synthetic rows after the cleaning steps run by main.py."""
+    if n_rows not in _clean_cache:
+        _clean_cache[n_rows] = clean_collisions(raw_df.copy())
+    return _clean_cache[n_rows]
+
+
+@pytest.fixture
+def run_benchmark(request, benchmark):
+    """
+    Times fn with pytest-benchmark, then runs it once more under tracemalloc to
+    record peak memory (and figure JSON size when fn returns a figure).
+    """
+    config = request.config
+    rounds = config.getoption('--bench-rounds')
+    max_regression = config.getoption('--bench-max-regression')
+    baseline = {}
+    if config.getoption('--bench-check-baseline') and os.path.exists(config.getoption('--bench-baseline')):
+        with open(config.getoption('--bench-baseline')) as f:
+            baseline = json.load(f)
+
+    def run(fn, setup=None):
+        """
+        :param fn: callable to benchmark, receives the args returned by setup
+        :param setup: optional callable returning a tuple of fresh args for each round
+        :return: returns the result of the memory-tracked call
+        """
+        def pedantic_setup():
+            return (setup() if setup else ()), {}
+
+        benchmark.pedantic(fn, setup=pedantic_setup, rounds=rounds, iterations=1)
+
+        args = setup() if setup else ()
+        tracemalloc.start()
+        try:
+            result = fn(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        metrics = {'peak_memory_bytes': peak}
+        if isinstance(result, go.Figure):
+            metrics['figure_json_bytes'] = len(result.to_json())
+        benchmark.extra_info.update(metrics)
+        _results[request.node.nodeid] = metrics
+
+        # compare against the recorded baseline, if there is one for this benchmark
+        expected = baseline.get(request.node.nodeid, {})
+        for name, value in metrics.items():
+            if name in expected:
+                limit = expected[name] * (1 + max_regression / 100)
+                assert value <= limit, (f'{name} regressed: {value:,} > {limit:,.0f} '
+                                        f'(baseline {expected[name]:,} + {max_regression}%)')
+        return result
+
+    return run
@@ -0,0 +1,117 @@
+"""
+Benchmarks for ingestion, filtering and figure generation over synthetic data.
+See conftest.py for the available options.
+"""
+import pandas as pd
+import pytest
+
+from bitmap_index import BitmapIndex
+from columnar_store import write_columnar, read_columnar
+from density_grid import DensityGrid
+from stratified_sample import StratifiedSample, WEIGHT_COLUMN
+from nyc_open_data_api import NYCOpenDataAPI
+import components.nyc_collision_map as nd
+import components.sankey as sk
+
+YR_START = 2020
+YR_END = 2023
+BOROUGHS = ['Manhattan', 'Brooklyn', 'Queens', 'Bronx', 'Staten Island']
+SANKEY_COLS = ['contributing_factor_vehicle_1', 'vehicle_type_code1']
+HIST_COLS = ['number_of_persons_injured', 'number_of_persons_killed']
+
+
+def test_process_strings(run_benchmark, raw_df):
+    # process_strings works in place, so every round gets a fresh copy
+    df = run_benchmark(NYCOpenDataAPI.process_strings, setup=lambda: (raw_df.copy(),))
+    assert df['borough'].isin(BOROUGHS).all()
+
+
+def test_convert_time_col_to_ranges(run_benchmark, raw_df):
+    times = run_benchmark(lambda: NYCOpenDataAPI.convert_time_col_to_ranges(raw_df, 'crash_time'))
+    assert times.str.fullmatch(r'\d{2}-\d{2}').all()
+
+
+@pytest.fixture
+def cache_files(tmp_path, clean_df):
+    parquet, columnar = tmp_path / 'collisions.parquet', tmp_path / 'collisions.ncol'
+    clean_df.to_parquet(parquet)
+    write_columnar(clean_df, columnar)
+    return parquet, columnar
+
+
+def test_load_parquet(run_benchmark, cache_files):
+    df = run_benchmark(lambda: pd.read_parquet(cache_files[0]))
+    assert len(df)
+
+
+def test_load_columnar(run_benchmark, cache_files):
+    df = run_benchmark(lambda: read_columnar(cache_files[1]))
+    assert len(df)
+
+
+def test_filter_by_year_and_borough(run_benchmark, clean_df):
+    filtered = run_benchmark(lambda: NYCOpenDataAPI.filter_by_year_and_borough(
+        clean_df, yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS[:2]))
+    assert filtered['borough'].isin(BOROUGHS[:2]).all()
+
+
+@pytest.fixture(scope='module')
+def crossfilter_case(clean_df):
+    index = BitmapIndex(clean_df)
+    filters = {'contributing_factor_vehicle_1': index.values('contributing_factor_vehicle_1')[:3],
+               'crash_time': index.values('crash_time')[:6]}
+    return index, filters
+
+
+def test_crossfilter_masks(run_benchmark, clean_df, crossfilter_case):
+    _, filters = crossfilter_case
+    filtered = run_benchmark(lambda: NYCOpenDataAPI.crossfilter(
+        clean_df, yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS[:2], filters=filters))
+    assert filtered['borough'].isin(BOROUGHS[:2]).all()
+
+
+def test_crossfilter_bitmap_index(run_benchmark, clean_df, crossfilter_case):
+    index, filters = crossfilter_case
+    filtered = run_benchmark(lambda: NYCOpenDataAPI.crossfilter(
+        clean_df, yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS[:2], filters=filters, index=index))
+    assert filtered['borough'].isin(BOROUGHS[:2]).all()
+
+
+def test_generate_nyc_map(run_benchmark, clean_df):
+    fig = run_benchmark(lambda: nd.generate_nyc_map(
+        clean_df, 'latitude', 'longitude', yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS))
+    assert len(fig.data) == len(BOROUGHS)
+
+
+def test_generate_nyc_map_sampled(run_benchmark, clean_df):
+    # the whole history drawn from the stratified sample, as approximate views are
+    sample = StratifiedSample(clean_df)
+    fig = run_benchmark(lambda: nd.generate_nyc_map(
+        sample.df, 'latitude', 'longitude', yr_start=2012, yr_end=2025, boroughs=BOROUGHS,
+        index=sample.index, weight=WEIGHT_COLUMN))
+    assert fig.layout.annotations[-1].text.endswith('(sampled)')
+
+
+def test_generate_density_map(run_benchmark, clean_df):
+    # the whole history from the precomputed grids, which costs the same for any number of rows
+    grid = DensityGrid(clean_df, 'latitude', 'longitude')
+    fig = run_benchmark(lambda: nd.generate_density_map(grid, yr_start=2012, yr_end=2025, boroughs=BOROUGHS))
+    assert len(fig.data[0].z) == len(grid.cells)
+
+
+def test_generate_sankey(run_benchmark, clean_df):
+    fig = run_benchmark(lambda: nd.generate_sankey(
+        clean_df, cols=SANKEY_COLS, yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS))
+    assert fig.data[0].type == 'sankey'
+
+
+def test_make_sankey(run_benchmark, clean_df):
+    grouped = clean_df.groupby(SANKEY_COLS + ['crash_time']).size().reset_index(name='count')
+    fig = run_benchmark(lambda: sk.make_sankey(grouped, SANKEY_COLS + ['crash_time'], vals='count'))
+    assert len(fig.data[0].link.value) == 2 * len(grouped)
+
+
+def test_generate_hist(run_benchmark, clean_df):
+    fig = run_benchmark(lambda: nd.generate_hist(
+        clean_df, cols=HIST_COLS, yr_start=YR_START, yr_end=YR_END, boroughs=BOROUGHS))
+    assert len(fig.data) == len(HIST_COLS)
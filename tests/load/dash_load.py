@@ -0,0 +1,396 @@
+"""
+Load harness for the dashboard's callbacks, served by gunicorn on synthetic data.
+Simulated users load the page, then drag the year slider, toggle boroughs in the map legend and change the
+sankey checklist, sending the same _dash-update-component requests the browser would. Reports latency
+percentiles per callback, throughput and the RSS of every gunicorn worker.
+
+Usage (from project root):
+    python tests/load/dash_load.py                                    # 50 users for 60s, 2 workers
+    python tests/load/dash_load.py --users 100 --workers 4 --threads 8 --rows 1000000
+    python tests/load/dash_load.py --actions slider --think 0.2 --preload
+"""
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+# Add tests/ and backend/ to path so imports work from the tests/load folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from synthetic import generate_collisions, clean_collisions
+
+BACKEND_DIR = os.path.join(PROJECT_ROOT, 'backend')
+CACHE_FILE = 'collision_data.parquet'  # read by main.py from its working directory
+
+ACTIONS = ('slider', 'legend', 'checklist')
+
+# interactions that arrive several steps at a time, like the slider's handle passing over years
+DRAG_STEPS = (2, 5)
+DRAG_PAUSE = 0.1
+
+
+def _parse_output(output):
+    """
+    :param output: callback output string from /_dash-dependencies, e.g. '..nyc_map.figure...nyc_map_state.data..'
+    :return: returns a list of (id, property) pairs, keeping the @hash of allow_duplicate outputs
+    """
+    if output.startswith('..'):
+        return [tuple(part.split('.', 1)) for part in output[2:-2].split('...')]
+    return [tuple(output.split('.', 1))]
+
+
+def _layout_props(node, props):
+    """
+    :param node: component (or list or value) of the /_dash-layout tree
+    :param props: dict filled with 'id.property' -> value for every component with an id
+    """
+    if isinstance(node, list):
+        for child in node:
+            _layout_props(child, props)
+    elif isinstance(node, dict) and 'props' in node:
+        component_id = node['props'].get('id')
+        for prop, value in node['props'].items():
+            if component_id is not None:
+                props[f'{component_id}.{prop}'] = value
+            _layout_props(value, props)
+
+
+class Callback:
+    def __init__(self, dependency):
+        """
+        :description: one callback of the app, as described by /_dash-dependencies
+        :param dependency: entry of /_dash-dependencies
+        """
+        self.output = dependency['output']
+        self.outputs = _parse_output(self.output)
+        self.multi = self.output.startswith('..')
+        self.inputs = [f"{i['id']}.{i['property']}" for i in dependency['inputs']]
+        self.state = [f"{s['id']}.{s['property']}" for s in dependency['state']]
+        self.prevent_initial_call = dependency['prevent_initial_call']
+
+        # allow_duplicate outputs are the refinements that follow a sampled view
+        first_id, first_prop = self.outputs[0]
+        self.name = first_id + (' (refine)' if '@' in first_prop else '')
+        self.targets = {f"{component_id}.{prop.split('@')[0]}" for component_id, prop in self.outputs}
+
+
+class DashUser:
+    def __init__(self, url, callbacks, layout, record, seed):
+        """
+        :description: a browser tab: holds the props of every component and fires the callbacks whose inputs
+                      change, following chains of callbacks the way dash-renderer does. Callbacks that are ready
+                      at the same time are sent concurrently, like the browser
+        :param url: root url of the app
+        :param callbacks: list of Callback
+        :param layout: 'id.property' -> initial value from /_dash-layout
+        :param record: function called with (callback name, seconds, status) after every request
+        :param seed: seed for the user's choices
+        """
+        self.url = url
+        self.callbacks = callbacks
+        self.props = dict(layout)
+        self.record = record
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=len(callbacks)))
+        self.pool = ThreadPoolExecutor(max_workers=len(callbacks))
+        self.hidden = set()
+
+    def _payload(self, callback, changed):
+        outputs = [{'id': component_id, 'property': prop} for component_id, prop in callback.outputs]
+        return {
+            'output': callback.output,
+            'outputs': outputs if callback.multi else outputs[0],
+            'inputs': [self._prop(key) for key in callback.inputs],
+            'state': [self._prop(key) for key in callback.state],
+            'changedPropIds': [key for key in callback.inputs if key in changed],
+        }
+
+    def _prop(self, key):
+        component_id, prop = key.split('.', 1)
+        return {'id': component_id, 'property': prop, 'value': self.props.get(key)}
+
+    def _send(self, callback, changed):
+        """
+        :return: returns the set of 'id.property' keys the callback updated
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f'{self.url}/_dash-update-component', json=self._payload(callback, changed),
+                                         timeout=120)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 'error'
+        self.record(callback.name, time.perf_counter() - start, status)
+
+        if status != 200:  # 204 is every output left as no_update
+            return set()
+        updated = set()
+        for component_id, values in response.json()['response'].items():
+            for prop, value in values.items():
+                key = f'{component_id}.{prop}'
+                # figures updated with a Patch aren't inputs or state of anything, so they're not applied
+                if not (isinstance(value, dict) and '__dash_patch_update' in value):
+                    self.props[key] = value
+                updated.add(key)
+        return updated
+
+    def _run(self, changed, initial=False):
+        """
+        :param changed: set of 'id.property' keys that changed, empty on page load
+        :param initial: True on page load, where every callback without prevent_initial_call fires
+        """
+        pending = [c for c in self.callbacks
+                   if (initial and not c.prevent_initial_call) or any(key in changed for key in c.inputs)]
+        while pending:
+            # a callback waits while another pending callback can still change one of its inputs
+            ready = [c for c in pending
+                     if not any(other is not c and other.targets & set(c.inputs) for other in pending)] or pending
+            pending = [c for c in pending if c not in ready]
+
+            updated = set().union(*self.pool.map(lambda c: self._send(c, changed), ready))
+            changed = updated
+            pending += [c for c in self.callbacks if c not in pending and any(key in updated for key in c.inputs)]
+
+    def set_props(self, values):
+        """
+        :param values: 'id.property' -> new value, as if the user changed them in the page
+        """
+        self.props.update(values)
+        self._run(set(values))
+
+    def load(self):
+        self._run(set(), initial=True)
+
+    def drag_slider(self):
+        lo, hi = self.props['year_range_slider.min'], self.props['year_range_slider.max']
+        handle = self.random.randrange(2)
+        step = self.random.choice((-1, 1))
+        for _ in range(self.random.randint(*DRAG_STEPS)):
+            value = list(self.props['year_range_slider.value'])
+            value[handle] = min(max(value[handle] + step, lo), hi)
+            if value[0] > value[1] or value == self.props['year_range_slider.value']:
+                break
+            self.set_props({'year_range_slider.value': value})
+            time.sleep(DRAG_PAUSE)
+
+    def toggle_legend(self):
+        traces = (self.props.get('nyc_map_state.data') or {}).get('traces') or []
+        if not traces:
+            return
+        i = self.random.randrange(len(traces))
+        visible = True if i in self.hidden else 'legendonly'
+        self.hidden ^= {i}
+        self.set_props({'nyc_map.restyleData': [{'visible': [visible]}, [i]]})
+
+    def toggle_checklist(self):
+        options = [o['value'] for o in self.props['sankey_columns_checklist.options']]
+        selected = list(self.props['sankey_columns_checklist.value'])
+        choice = self.random.choice(options)
+        if choice in selected:
+            if len(selected) <= 2:  # the sankey needs two columns to draw links
+                return
+            selected.remove(choice)
+        else:
+            selected.append(choice)
+        self.set_props({'sankey_columns_checklist.value': [o for o in options if o in selected]})
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
+
+
+def run_user(url, callbacks, layout, record, seed, actions, think, stop):
+    """
+    :description: loads the page, then performs random actions with random think time until stop is set
+    """
+    user = DashUser(url, callbacks, layout, record, seed)
+    handlers = {'slider': user.drag_slider, 'legend': user.toggle_legend, 'checklist': user.toggle_checklist}
+    try:
+        user.load()
+        while not stop.is_set():
+            handlers[user.random.choice(actions)]()
+            stop.wait(user.random.expovariate(1 / think) if think else 0)
+    finally:
+        user.close()
+
+
+def worker_rss(master_pid):
+    """
+    :param master_pid: pid of the gunicorn master
+    :return: returns {pid: RSS in bytes} of the master and its workers, read from /proc (Linux only)
+    """
+    pids = [master_pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # the command name can hold spaces, the ppid is the second field after it
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == master_pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+
+    rss = {}
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                line = next(line for line in f if line.startswith('VmRSS:'))
+            rss[pid] = int(line.split()[1]) * 1024
+        except (OSError, StopIteration):
+            continue
+    return rss
+
+
+def sample_rss(master_pid, peaks, stop, interval=0.5):
+    """
+    :description: keeps the peak RSS of every process of the gunicorn master in peaks until stop is set
+    """
+    while not stop.is_set():
+        for pid, rss in worker_rss(master_pid).items():
+            peaks[pid] = max(peaks.get(pid, 0), rss)
+        stop.wait(interval)
+
+
+def start_server(workdir, port, workers, threads, preload, startup_timeout):
+    """
+    :param workdir: directory holding the synthetic collision_data.parquet, used as the app's working directory
+    :return: returns the gunicorn process once the app answers, serving main:server like the deployment
+    """
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+               '--bind', f'127.0.0.1:{port}', '--chdir', workdir, '--pythonpath', BACKEND_DIR,
+               '--timeout', '300', '--log-level', 'warning'] + (['--preload'] if preload else []) + ['main:server']
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {process.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/_dash-layout', timeout=5).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    process.terminate()
+    raise RuntimeError(f'app did not start within {startup_timeout}s')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def print_report(latencies, seconds, peaks, master_pid):
+    header = f"{'callback':<22} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    print(header)
+    print('-' * len(header))
+    everything = []
+    for name in sorted(latencies, key=lambda name: -len(latencies[name])):
+        samples = latencies[name]
+        everything += samples
+        ms = np.array([s for s, _ in samples]) * 1e3
+        errors = sum(status not in (200, 204) for _, status in samples)
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        print(f'{name:<22} {len(samples):>8} {errors:>6} {p50:>8.0f} {p95:>8.0f} {p99:>8.0f} {ms.max():>8.0f}')
+
+    if everything:
+        ms = np.array([s for s, _ in everything]) * 1e3
+        errors = sum(status not in (200, 204) for _, status in everything)
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        print('-' * len(header))
+        print(f"{'all':<22} {len(everything):>8} {errors:>6} {p50:>8.0f} {p95:>8.0f} {p99:>8.0f} {ms.max():>8.0f}")
+    print(f'throughput: {len(everything) / seconds:.1f} requests/s over {seconds:.0f}s')
+
+    if not peaks:
+        print('worker RSS unavailable (needs /proc)')
+    for pid in sorted(peaks, key=lambda pid: (pid != master_pid, pid)):
+        role = 'master' if pid == master_pid else 'worker'
+        print(f'{role} {pid} peak RSS: {peaks[pid] / 1e6:.0f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dashboard callbacks under gunicorn')
+    parser.add_argument('--rows', type=int, default=250_000, help='Synthetic rows served by the app')
+    parser.add_argument('--users', type=int, default=50, help='Simultaneous users')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of interaction after ramp-up')
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds over which users arrive')
+    parser.add_argument('--think', type=float, default=1.0, help='Mean seconds between a user\'s actions')
+    parser.add_argument('--actions', type=str, default=','.join(ACTIONS), help='Comma separated actions to mix')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per gunicorn worker')
+    parser.add_argument('--preload', action='store_true', default=False,
+                        help='Load the app once in the gunicorn master and fork the workers from it')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='Seconds to wait for the app')
+    args = parser.parse_args()
+
+    actions = args.actions.split(',')
+    unknown = set(actions) - set(ACTIONS)
+    if unknown:
+        parser.error(f"unknown actions {', '.join(sorted(unknown))}, choose from {', '.join(ACTIONS)}")
+
+    workdir = tempfile.mkdtemp(prefix='dash_load_')
+    print(f'Generating {args.rows:,} rows...')
+    clean_collisions(generate_collisions(args.rows)).to_parquet(os.path.join(workdir, CACHE_FILE))
+
+    port = _free_port()
+    url = f'http://127.0.0.1:{port}'
+    print(f'Starting gunicorn with {args.workers} workers x {args.threads} threads...')
+    process = start_server(workdir, port, args.workers, args.threads, args.preload, args.startup_timeout)
+
+    latencies = defaultdict(list)
+    lock = threading.Lock()
+
+    def record(name, seconds, status):
+        with lock:
+            latencies[name].append((seconds, status))
+
+    peaks = {}
+    stop, stop_sampler = threading.Event(), threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(process.pid, peaks, stop_sampler), daemon=True)
+    try:
+        callbacks = [Callback(d) for d in requests.get(f'{url}/_dash-dependencies', timeout=30).json()]
+        layout = {}
+        _layout_props(requests.get(f'{url}/_dash-layout', timeout=30).json(), layout)
+
+        if os.path.isdir('/proc'):
+            sampler.start()
+        print(f'Running {args.users} users for {args.duration:.0f}s...')
+        threads = [threading.Thread(target=run_user, args=(url, callbacks, layout, record, seed, actions,
+                                                           args.think, stop))
+                   for seed in range(args.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+            time.sleep(args.ramp / args.users)
+        time.sleep(max(args.duration - (time.perf_counter() - start - args.ramp), 0))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        stop_sampler.set()
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(latencies, elapsed, peaks, process.pid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Load harness for NYCOpenDataAPI.fetch_data against the local mock SODA server.
+Measures fetch throughput, retry overhead and memory without touching the live API.
+
+Usage (from project root):
+    python tests/load/fetch_load.py                                   # 1M rows, every scenario
+    python tests/load/fetch_load.py --rows 5000000 --page-size 500000
+    python tests/load/fetch_load.py --scenarios clean,errors --error-rate 0.2
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from urllib.parse import urlparse
+
+import requests
+
+# Add tests/ and backend/ to path so imports work from the tests/load folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from nyc_open_data_api import NYCOpenDataAPI
+from mock_soda import serve_in_process
+from synthetic import COLUMNS
+
+# scenario name -> server settings applied before the run
+SCENARIOS = {
+    'clean': {},
+    'latency': {'latency': None},        # filled from --latency
+    'throttled': {'fail_first': 2, 'error_statuses': '429'},
+    'errors': {'error_rate': None, 'error_statuses': '500,502,503,504'},  # filled from --error-rate
+}
+
+
+def run_scenario(url, name, settings, rows, page_size):
+    """
+    :param url: resource url of the running mock server
+    :param name: scenario name, used in the report
+    :param settings: fault injection settings sent to the mock server for this run
+    :param rows: number of rows to ask fetch_data for
+    :param page_size: page size handed to fetch_data, None for a single request
+    :return: returns a dict of measurements for the run
+    """
+    control = url.replace(urlparse(url).path, '/_mock')
+    defaults = {'latency': 0.0, 'error_rate': 0.0, 'fail_first': 0,
+                'error_statuses': '429,500,502,503,504'}
+    requests.get(f'{control}/config', params={**defaults, **settings}, timeout=5).raise_for_status()
+
+    api = NYCOpenDataAPI(url, key=None)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = api.fetch_data(columns=COLUMNS, limit=rows, page_size=page_size)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = requests.get(f'{control}/stats', timeout=5).json()
+    fetched = 0 if df is None else len(df)
+    return {
+        'scenario': name,
+        'rows': fetched,
+        'seconds': elapsed,
+        'rows_per_sec': fetched / elapsed if elapsed else 0,
+        'requests': stats['requests'],
+        'retries': stats['errors'],
+        'mb_sent': stats['bytes_sent'] / 1e6,
+        'peak_mb': peak / 1e6,
+    }
+
+
+def print_report(results):
+    header = f"{'scenario':<10} {'rows':>10} {'seconds':>8} {'rows/s':>10} {'requests':>8} " \
+             f"{'retries':>7} {'MB sent':>8} {'peak MB':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<10} {r['rows']:>10,} {r['seconds']:>8.2f} {r['rows_per_sec']:>10,.0f} "
+              f"{r['requests']:>8} {r['retries']:>7} {r['mb_sent']:>8.1f} {r['peak_mb']:>8.1f}")
+
+    # retry overhead is the extra wall time compared to the clean run
+    clean = next((r for r in results if r['scenario'] == 'clean'), None)
+    if clean:
+        for r in results:
+            if r is not clean:
+                print(f"{r['scenario']} overhead vs clean: {r['seconds'] - clean['seconds']:+.2f}s")
+
+    # ru_maxrss is reported in kilobytes on Linux, and only covers this (client) process
+    print(f"client max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test fetch_data against a mock SODA server')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Rows served and fetched')
+    parser.add_argument('--page-size', type=int, default=None, help='Page size for fetch_data')
+    parser.add_argument('--latency', type=float, default=0.2, help='Latency for the latency scenario')
+    parser.add_argument('--error-rate', type=float, default=0.3, help='Error rate for the errors scenario')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run')
+    args = parser.parse_args()
+
+    print(f'Generating {args.rows:,} rows...')
+    process, url = serve_in_process(args.rows)
+    try:
+        results = []
+        for name in args.scenarios.split(','):
+            settings = dict(SCENARIOS[name])
+            if 'latency' in settings:
+                settings['latency'] = args.latency
+            if 'error_rate' in settings:
+                settings['error_rate'] = args.error_rate
+            print(f'Running {name}...')
+            results.append(run_scenario(url, name, settings, args.rows, args.page_size))
+    finally:
+        process.terminate()
+
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""
+Local stand-in for the NYC Open Data (SODA) CSV endpoint, serving synthetic collisions.
+
+Understands the parts of the SODA query language NYCOpenDataAPI uses:
+$select (columns, count(*), date_extract_y and AS aliases), $where (comparisons,
+IS [NOT] NULL, joined with AND), $group, $limit, $offset and $order.
+Latency, 429s and 5xx responses can be injected to exercise the client's retry logic.
+Like the portal, it serves the dataset's rowsUpdatedAt from /api/views/<id>.json, answers conditional
+requests (If-None-Match, If-Modified-Since) with 304 while the rows are unchanged, and gzips responses.
+
+Counters and fault injection can be read and changed at runtime through
+/_mock/stats and /_mock/config?latency=..&error_rate=..&fail_first=..&error_statuses=429,503&rows_updated_at=..
+
+Usage (from project root):
+    python tests/mock_soda.py --rows 1000000 --port 8765 --latency 0.05 --error-rate 0.1
+then point the dashboard at it:
+    python backend/main.py --url http://127.0.0.1:8765/resource/h9gi-nx95.csv
+"""
+import argparse
+import email.utils
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate_collisions
+
+RESOURCE_PATH = '/resource/h9gi-nx95.csv'
+METADATA_PATH = '/api/views/h9gi-nx95.json'
+DEFAULT_LIMIT = 1000
+
+_COMPARISON = re.compile(r"^(\w+)\s*(>=|<=|!=|=|>|<)\s*'([^']*)'$")
+_NULL_CHECK = re.compile(r'^(\w+)\s+IS\s+(NOT\s+)?NULL$', re.IGNORECASE)
+_SELECT_ITEM = re.compile(r'^(?:(\w+)\((\*|\w+)\)|(\w+))(?:\s+AS\s+(\w+))?$', re.IGNORECASE)
+
+
+class SodaQueryError(ValueError):
+    """Raised for query strings the mock server does not understand (served as a 400)."""
+
+
+def _where_mask(df, where):
+    """
+    :param df: dataset to filter
+    :param where: SODA $where clause, e.g. "CRASH_DATE >= '2020-01-01' AND BOROUGH IS NOT NULL"
+    :return: returns a boolean series selecting the matching rows
+    """
+    mask = pd.Series(True, index=df.index)
+    for clause in re.split(r'\s+AND\s+', where.strip(), flags=re.IGNORECASE):
+        clause = clause.strip()
+        if match := _NULL_CHECK.match(clause):
+            col, negate = match.group(1).lower(), match.group(2)
+            mask &= df[col].notna() if negate else df[col].isna()
+        elif match := _COMPARISON.match(clause):
+            col, op, value = match.group(1).lower(), match.group(2), match.group(3)
+            column = df[col]
+            # compare numerically when the column is numeric, otherwise as strings (ISO dates sort lexically)
+            if pd.api.types.is_numeric_dtype(column):
+                value = float(value)
+            mask &= {'>=': column >= value, '<=': column <= value, '>': column > value,
+                     '<': column < value, '=': column == value, '!=': column != value}[op]
+        else:
+            raise SodaQueryError(f'Unsupported $where clause: {clause}')
+    return mask
+
+
+def _parse_select(select):
+    """
+    :param select: SODA $select clause
+    :return: returns a list of (function, argument, output name) tuples, function is None for plain columns
+    """
+    items = []
+    for item in select.split(','):
+        match = _SELECT_ITEM.match(item.strip())
+        if not match:
+            raise SodaQueryError(f'Unsupported $select item: {item.strip()}')
+        function, argument, column, alias = match.groups()
+        if function:
+            function = function.lower()
+            if function not in ('count', 'date_extract_y'):
+                raise SodaQueryError(f'Unsupported function: {function}')
+            items.append((function, argument.lower(), (alias or f'{function}_{argument}').lower()))
+        else:
+            items.append((None, column.lower(), (alias or column).lower()))
+    return items
+
+
+def _run_aggregate(df, select, group):
+    """
+    :param df: rows left after the $where clause
+    :param select: SODA $select clause containing count(*)
+    :param group: SODA $group clause, naming columns or $select aliases
+    :return: returns one row per group with the selected columns and counts
+    """
+    items = _parse_select(select)
+
+    # materialize derived columns (e.g. date_extract_y(crash_date) AS year) so they can be grouped on
+    derived = {}
+    for function, argument, name in items:
+        if function == 'date_extract_y':
+            derived[name] = df[argument].str[:4].astype(int)
+        elif function is None and name != argument:
+            derived[name] = df[argument]
+    if derived:
+        df = df.assign(**derived)
+
+    keys = [key.strip().lower() for key in group.split(',')] if group else []
+    count_names = [name for function, _, name in items if function == 'count']
+    grouped = df.groupby(keys, dropna=False).size() if keys else pd.Series([len(df)])
+    result = grouped.reset_index(name='_count') if keys else pd.DataFrame({'_count': grouped})
+    for name in count_names:
+        result[name] = result['_count']
+    return result[[name for _, _, name in items]]
+
+
+def run_query(df, params):
+    """
+    :param df: dataset to query, with lowercase column names
+    :param params: dict of SODA query parameters ($select, $where, $group, $limit, $offset, $order)
+    :return: returns the df of rows the real endpoint would return for params
+    """
+    if params.get('$where'):
+        df = df[_where_mask(df, params['$where'])]
+
+    # aggregate queries group and count before ordering and paging
+    if params.get('$group') or 'count(' in params.get('$select', '').lower():
+        df = _run_aggregate(df, params['$select'], params.get('$group'))
+        params = {key: value for key, value in params.items() if key != '$select'}
+
+    if params.get('$order'):
+        keys, ascending = [], []
+        for term in params['$order'].split(','):
+            parts = term.split()
+            # :id is the row identifier, which the stable sort already preserves
+            if parts[0] == ':id':
+                continue
+            keys.append(parts[0].lower())
+            ascending.append(len(parts) < 2 or parts[1].upper() != 'DESC')
+        if keys:
+            df = df.sort_values(keys, ascending=ascending, kind='stable')
+
+    offset = int(params.get('$offset', 0))
+    limit = int(params.get('$limit', DEFAULT_LIMIT))
+    df = df.iloc[offset:offset + limit]
+
+    if params.get('$select'):
+        cols = [col.strip().lower() for col in params['$select'].split(',')]
+        missing = [col for col in cols if col not in df.columns]
+        if missing:
+            raise SodaQueryError(f'Unknown columns in $select: {missing}')
+        df = df[cols]
+
+    return df
+
+
+class MockSodaServer:
+    def __init__(self, df, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 error_statuses=(429, 500, 502, 503, 504), fail_first=0, seed=0, rows_updated_at=None):
+        """
+        :description: serves df over HTTP like the SODA CSV endpoint
+        :param df: dataset to serve, columns named like the API's CSV output
+        :param host: host to bind to
+        :param port: port to bind to, 0 picks a free one
+        :param latency: seconds to sleep before answering each request
+        :param error_rate: probability of answering a request with one of error_statuses
+        :param error_statuses: statuses to choose from when injecting an error
+        :param fail_first: always fail this many requests before serving any data
+        :param seed: seed for the error injection so runs are reproducible
+        :param rows_updated_at: unix seconds the rows last changed, reported by the metadata endpoint and
+                                used to validate conditional requests, now if None
+        """
+
+        self.df = df
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.fail_first = fail_first
+        self.random = random.Random(seed)
+        self.rows_updated_at = int(time.time()) if rows_updated_at is None else rows_updated_at
+
+        # counters read by the load harness
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        :return: returns the resource url to hand to NYCOpenDataAPI
+        """
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}{RESOURCE_PATH}'
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = self.errors = self.not_modified = self.bytes_sent = 0
+
+    def stats(self):
+        """
+        :return: returns a dict of the request counters
+        """
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'not_modified': self.not_modified,
+                    'bytes_sent': self.bytes_sent}
+
+    def configure(self, params):
+        """
+        :description: updates fault injection settings and resets the counters
+        :param params: dict with any of latency, error_rate, fail_first, error_statuses (comma separated) and
+                       rows_updated_at, which publishes a change to the rows
+        """
+        if 'latency' in params:
+            self.latency = float(params['latency'])
+        if 'error_rate' in params:
+            self.error_rate = float(params['error_rate'])
+        if 'fail_first' in params:
+            self.fail_first = int(params['fail_first'])
+        if 'error_statuses' in params:
+            self.error_statuses = [int(code) for code in params['error_statuses'].split(',')]
+        if 'rows_updated_at' in params:
+            self.rows_updated_at = int(params['rows_updated_at'])
+        self.reset_counters()
+
+    def _not_modified(self, query, headers):
+        """
+        :param query: query string of the request
+        :param headers: request headers
+        :return: returns the ETag and Last-Modified of the answer, and whether the client's copy is still current
+        """
+        etag = '"' + hashlib.sha1(f'{self.rows_updated_at}?{query}'.encode()).hexdigest()[:16] + '"'
+        last_modified = email.utils.formatdate(self.rows_updated_at, usegmt=True)
+
+        # If-Modified-Since is only considered without If-None-Match
+        if headers.get('If-None-Match') is not None:
+            current = etag in [tag.strip() for tag in headers['If-None-Match'].split(',')]
+        elif headers.get('If-Modified-Since') is not None:
+            since = email.utils.parsedate_to_datetime(headers['If-Modified-Since']).timestamp()
+            current = self.rows_updated_at <= since
+        else:
+            current = False
+        return etag, last_modified, current
+
+    def _next_error(self):
+        """
+        :return: returns the status code to fail the current request with, or None to serve it
+        """
+        with self.lock:
+            self.requests += 1
+            if self.requests <= self.fail_first or self.random.random() < self.error_rate:
+                self.errors += 1
+                return self.random.choice(self.error_statuses)
+        return None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+
+                # control endpoints used by the load harness
+                if parsed.path == '/_mock/config':
+                    server.configure(params)
+                if parsed.path in ('/_mock/config', '/_mock/stats'):
+                    self._send(200, json.dumps(server.stats()).encode(), 'application/json', count=False)
+                    return
+
+                if parsed.path == METADATA_PATH:
+                    metadata = {'id': os.path.splitext(os.path.basename(RESOURCE_PATH))[0],
+                                'rowsUpdatedAt': server.rows_updated_at}
+                    self._send(200, json.dumps(metadata).encode(), 'application/json')
+                    return
+
+                if parsed.path != RESOURCE_PATH:
+                    self._send(404, b'Not found', 'text/plain')
+                    return
+
+                if server.latency:
+                    time.sleep(server.latency)
+
+                status = server._next_error()
+                if status is not None:
+                    # Retry-After: 0 so urllib3 falls back to its own backoff schedule
+                    self._send(status, b'Injected failure', 'text/plain', {'Retry-After': '0'})
+                    return
+
+                etag, last_modified, current = server._not_modified(parsed.query, self.headers)
+                validators = {'ETag': etag, 'Last-Modified': last_modified}
+                if current:
+                    with server.lock:
+                        server.not_modified += 1
+                    self._send(304, b'', 'text/csv', validators)
+                    return
+
+                try:
+                    result = run_query(server.df, params)
+                except (SodaQueryError, KeyError, ValueError) as e:
+                    self._send(400, str(e).encode(), 'text/plain')
+                    return
+                self._send(200, result.to_csv(index=False).encode(), 'text/csv', validators)
+
+            def _send(self, status, body, content_type, headers=None, count=True):
+                headers = dict(headers or {})
+                if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=6)
+                    headers['Content-Encoding'] = 'gzip'
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                if count:
+                    with server.lock:
+                        server.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass  # keep load runs quiet
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _serve(rows, settings, queue):
+    mock = MockSodaServer(generate_collisions(rows), **settings)
+    queue.put(mock.url)
+    mock.httpd.serve_forever()
+
+
+def serve_in_process(rows, **settings):
+    """
+    :description: runs the mock server in a child process so it does not share the GIL
+                  or tracemalloc with the client being measured
+    :param rows: number of synthetic rows to serve
+    :param settings: keyword arguments passed on to MockSodaServer
+    :return: returns the child process and the resource url it is serving
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(rows, settings, queue), daemon=True)
+    process.start()
+    return process, queue.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock NYC Open Data SODA endpoint')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of synthetic rows to serve')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('--port', type=int, default=8765, help='Port to serve on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of an injected 429/5xx')
+    parser.add_argument('--fail-first', type=int, default=0, help='Fail this many requests before serving')
+    args = parser.parse_args()
+
+    print(f'Generating {args.rows:,} rows...')
+    mock = MockSodaServer(generate_collisions(args.rows), host=args.host, port=args.port,
+                          latency=args.latency, error_rate=args.error_rate, fail_first=args.fail_first)
+    print(f'Serving on {mock.url}')
+    try:
+        mock.httpd.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,96 @@
+"""
+Synthetic collision data matching the COLUMNS schema pulled by backend/main.py.
+Used by the offline benchmark suite so nothing depends on the live API.
+"""
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['crash_date', 'crash_time', 'borough', 'latitude', 'longitude',
+           'on_street_name', 'contributing_factor_vehicle_1',
+           'vehicle_type_code1', 'number_of_persons_injured',
+           'number_of_persons_killed']
+
+# rough bounding box (lat, lon) of each borough so points land in the right place on the map
+BOROUGH_BOUNDS = {
+    'MANHATTAN': ((40.70, 40.88), (-74.02, -73.91)),
+    'BROOKLYN': ((40.57, 40.74), (-74.04, -73.86)),
+    'QUEENS': ((40.54, 40.80), (-73.96, -73.70)),
+    'BRONX': ((40.79, 40.92), (-73.93, -73.75)),
+    'STATEN ISLAND': ((40.49, 40.65), (-74.26, -74.05)),
+}
+BOROUGH_WEIGHTS = [0.22, 0.32, 0.28, 0.13, 0.05]
+
+STREETS = ['BROADWAY', 'ATLANTIC AVENUE', 'NORTHERN BOULEVARD', 'GRAND CONCOURSE', 'HYLAN BOULEVARD',
+           'QUEENS BOULEVARD', 'FLATBUSH AVENUE', '3 AVENUE', 'LINDEN BOULEVARD', 'BELT PARKWAY',
+           'FDR DRIVE', 'CROSS BRONX EXPRESSWAY', 'EASTERN PARKWAY', 'OCEAN PARKWAY', 'RICHMOND AVENUE']
+FACTORS = ['Unspecified', 'Driver Inattention/Distraction', 'Failure to Yield Right-of-Way',
+           'Following Too Closely', 'Backing Unsafely', 'Passing or Lane Usage Improper',
+           'Unsafe Speed', 'Traffic Control Disregarded', 'Other Vehicular', 'Alcohol Involvement']
+VEHICLES = ['Sedan', 'Station Wagon/Sport Utility Vehicle', 'Taxi', 'Pick-up Truck', 'Box Truck',
+            'Bus', 'Bike', 'Motorcycle', 'E-Bike', 'Van']
+
+
+def generate_collisions(n_rows, yr_start=2012, yr_end=2025, seed=0):
+    """
+    :param n_rows: number of synthetic collisions to generate
+    :param yr_start: first year of generated crash dates
+    :param yr_end: last year of generated crash dates
+    :param seed: seed for the random generator so runs are reproducible
+    :return: returns a raw (uncleaned) df shaped like the API's CSV response
+    """
+    rng = np.random.default_rng(seed)
+
+    # spread crash dates uniformly over the requested years
+    start = np.datetime64(f'{yr_start}-01-01')
+    n_days = int((np.datetime64(f'{yr_end + 1}-01-01') - start).astype(int))
+    days = start + rng.integers(0, n_days, n_rows).astype('timedelta64[D]')
+    crash_date = pd.Series(np.datetime_as_string(days, unit='D')) + 'T00:00:00.000'
+
+    # the API returns unpadded hours, e.g. '9:05'
+    hours = rng.integers(0, 24, n_rows)
+    minutes = rng.integers(0, 60, n_rows)
+    crash_time = pd.Series(hours.astype(str)) + ':' + pd.Series(minutes).map('{:02d}'.format)
+
+    # pick boroughs and place each point inside its borough's bounding box
+    names = list(BOROUGH_BOUNDS)
+    borough_idx = rng.choice(len(names), n_rows, p=BOROUGH_WEIGHTS)
+    lat_lo, lat_hi, lon_lo, lon_hi = (np.array([BOROUGH_BOUNDS[b][axis][side] for b in names])
+                                      for axis in (0, 1) for side in (0, 1))
+    latitude = rng.uniform(lat_lo[borough_idx], lat_hi[borough_idx])
+    longitude = rng.uniform(lon_lo[borough_idx], lon_hi[borough_idx])
+
+    # roughly 2% of real rows are missing coordinates
+    missing = rng.random(n_rows) < 0.02
+    latitude[missing] = np.nan
+    longitude[missing] = np.nan
+
+    # injuries and deaths are heavily skewed towards zero
+    injured = rng.poisson(0.3, n_rows)
+    killed = (rng.random(n_rows) < 0.002).astype(int)
+
+    # raw strings carry the inconsistent casing and whitespace that process_strings cleans up
+    return pd.DataFrame({
+        'crash_date': crash_date,
+        'crash_time': crash_time,
+        'borough': np.array(names, dtype=object)[borough_idx],
+        'latitude': latitude,
+        'longitude': longitude,
+        'on_street_name': np.array([s + '   ' for s in STREETS], dtype=object)[rng.integers(0, len(STREETS), n_rows)],
+        'contributing_factor_vehicle_1': np.array(FACTORS, dtype=object)[rng.integers(0, len(FACTORS), n_rows)],
+        'vehicle_type_code1': np.array(VEHICLES, dtype=object)[rng.integers(0, len(VEHICLES), n_rows)],
+        'number_of_persons_injured': injured,
+        'number_of_persons_killed': killed,
+    }, columns=COLUMNS)
+
+
+def clean_collisions(df):
+    """
+    :param df: raw df from generate_collisions
+    :return: returns the df cleaned the same way backend/main.py cleans a fresh API pull
+    """
+    from nyc_open_data_api import NYCOpenDataAPI
+
+    df = NYCOpenDataAPI.process_strings(df)
+    df['crash_time'] = NYCOpenDataAPI.convert_time_col_to_ranges(df, 'crash_time')
+    df['crash_date'] = pd.to_datetime(df['crash_date'])
+    return df
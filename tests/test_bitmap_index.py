@@ -0,0 +1,72 @@
+"""
+Tests that the bitmap index selects the same rows as filtering the df with boolean masks.
+Run from project root: pytest tests/test_bitmap_index.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from bitmap_index import BitmapIndex
+from nyc_open_data_api import NYCOpenDataAPI
+from synthetic import generate_collisions, clean_collisions
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(5000, yr_start=2015, yr_end=2024))
+
+
+@pytest.mark.parametrize('max_values', [256, 3])  # 3 leaves most values without a stored bitset
+def test_query_matches_masks(df, max_values):
+    index = BitmapIndex(df, max_values=max_values)
+    factors = index.values('contributing_factor_vehicle_1')[:2] + index.values('contributing_factor_vehicle_1')[-1:]
+    vehicles = index.values('vehicle_type_code1')[:3]
+    hours = index.values('crash_time')[:8]
+    boroughs = index.values('borough')[:2]
+
+    cases = [(2018, 2021, boroughs, {}),
+             (2015, 2024, None, {'contributing_factor_vehicle_1': factors}),
+             (2016, 2019, boroughs, {'contributing_factor_vehicle_1': factors, 'vehicle_type_code1': vehicles,
+                                     'crash_time': hours}),
+             (2020, 2020, None, {'vehicle_type_code1': [], 'crash_time': hours}),   # empty lists are ignored
+             (2017, 2023, boroughs, {'crash_time': ['not an hour']})]               # unknown values match nothing
+    for yr_start, yr_end, selected_boroughs, filters in cases:
+        expected = NYCOpenDataAPI.crossfilter(df, yr_start, yr_end, boroughs=selected_boroughs, filters=filters)
+        bits = index.query(yr_start, yr_end, boroughs=selected_boroughs, filters=filters)
+
+        assert index.count(bits) == len(expected)
+        assert df.index[index.rows(bits)].tolist() == expected.index.tolist()
+
+
+def test_select_combines_with_and_or(df):
+    index = BitmapIndex(df)
+    brooklyn, queens = index.select('borough', ['Brooklyn']), index.select('borough', ['Queens'])
+    night = index.select('crash_time', ['00-01', '01-02', '02-03'])
+
+    assert index.count(brooklyn | queens) == df['borough'].isin(['Brooklyn', 'Queens']).sum()
+    assert index.count((brooklyn | queens) & night) == \
+        (df['borough'].isin(['Brooklyn', 'Queens']) & df['crash_time'].isin(['00-01', '01-02', '02-03'])).sum()
+    assert index.count(brooklyn & queens) == 0
+
+
+def test_group_counts_match_groupby(df):
+    index = BitmapIndex(df)
+    rows = index.rows(index.query(2016, 2020, boroughs=['Queens']))
+    cols = ['vehicle_type_code1', 'crash_time']
+
+    counts = index.group_counts(rows, cols).set_index(cols)['count']
+    expected = df.iloc[rows].groupby(cols).size()
+    assert counts.sort_index().to_dict() == expected.sort_index().to_dict()
+
+
+def test_codes_use_smallest_dtype(df):
+    index = BitmapIndex(df)
+    for col, (codes, lookup) in index.codes.items():
+        assert codes.dtype == np.int8 if len(lookup) < 127 else codes.dtype == np.int16
@@ -0,0 +1,49 @@
+"""
+Tests for the columnar binary store in backend/columnar_store.py.
+Run from project root: pytest tests/test_columnar_store.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from columnar_store import write_columnar, read_columnar, ColumnarStoreError
+from synthetic import generate_collisions, clean_collisions
+
+
+def test_round_trip(tmp_path):
+    df = clean_collisions(generate_collisions(2000))
+    df.loc[::7, 'vehicle_type_code1'] = None
+    path = tmp_path / 'collisions.ncol'
+    write_columnar(df, path)
+    loaded = read_columnar(path)
+
+    assert list(loaded.columns) == list(df.columns)
+    assert (loaded['crash_date'] == df['crash_date']).all()
+    assert loaded['borough'].astype(object).equals(df['borough'].astype(object))
+    assert loaded['vehicle_type_code1'].isna().equals(df['vehicle_type_code1'].isna())
+    assert loaded['latitude'].dtype == np.float32
+    np.testing.assert_allclose(loaded['latitude'], df['latitude'], rtol=1e-6)
+    assert (loaded['number_of_persons_injured'] == df['number_of_persons_injured']).all()
+
+
+def test_rejects_other_files_and_versions(tmp_path):
+    path = tmp_path / 'collisions.ncol'
+    df = clean_collisions(generate_collisions(10))
+
+    path.write_bytes(b'PAR1 not a store')
+    with pytest.raises(ColumnarStoreError):
+        read_columnar(path)
+
+    write_columnar(df, path)
+    data = bytearray(path.read_bytes())
+    data[6] += 1  # bump the version field
+    path.write_bytes(bytes(data))
+    with pytest.raises(ColumnarStoreError, match='version'):
+        read_columnar(path)
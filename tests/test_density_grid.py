@@ -0,0 +1,74 @@
+"""
+Tests that the density grid's precomputed per-(year, borough) grids agree with binning the rows directly.
+Run from project root: pytest tests/test_density_grid.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import components.nyc_collision_map as nd
+from density_grid import DensityGrid, gaussian_matrix
+from synthetic import generate_collisions, clean_collisions
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(20000, yr_start=2015, yr_end=2024))
+
+
+@pytest.fixture(scope='module')
+def grid(df):
+    return DensityGrid(df, 'latitude', 'longitude', shape=(64, 64))
+
+
+@pytest.mark.parametrize('weight, col', [('collisions', None), ('injuries', 'number_of_persons_injured'),
+                                         ('fatalities', 'number_of_persons_killed')])
+def test_precomputed_grids_match_binning_rows(df, grid, weight, col):
+    year = df['crash_date'].dt.year
+    mask = year.between(2017, 2020) & df['borough'].isin(['Queens', 'Bronx']) & df['latitude'].notna()
+    positions = np.flatnonzero(mask.to_numpy())
+
+    values, total = grid.query(2017, 2020, boroughs=['Queens', 'Bronx'], weight=weight)
+    from_rows, rows_total = grid.query(2017, 2020, weight=weight, positions=positions)
+
+    np.testing.assert_allclose(values, from_rows, rtol=1e-4, atol=1e-4)
+    assert total == rows_total == (len(positions) if col is None else df.loc[mask, col].sum())
+
+
+def test_smoothing_spreads_without_losing_mass():
+    matrix = gaussian_matrix(41, sigma=2)
+    point = np.zeros(41)
+    point[20] = 1
+    smoothed = matrix @ point
+    assert smoothed.sum() == pytest.approx(1, rel=1e-5)
+    assert smoothed.argmax() == 20 and smoothed[16] > 0
+
+
+def test_density_patch_matches_rebuild(grid):
+    patch = nd.generate_density_map(grid, 2020, 2023, boroughs=['Brooklyn'], weight='injuries', patch=True)
+    rebuilt = nd.generate_density_map(grid, 2020, 2023, boroughs=['Brooklyn'], weight='injuries')
+
+    operations = {tuple(op['location']): op['params']['value'] for op in patch.to_plotly_json()['operations']}
+    assert operations[('data', 0, 'z')] == list(rebuilt.data[0].z)
+    assert operations[('layout', 'annotations', 0, 'text')] == rebuilt.layout.annotations[0].text
+    # the cost of a density view doesn't depend on the rows, only on the grid
+    assert len(rebuilt.data[0].z) == len(grid.cells) <= 64 * 64
+
+
+def test_missing_weights_count_as_zero(df):
+    df = df.copy()
+    df.loc[df.index[::7], 'number_of_persons_injured'] = np.nan
+    grid = DensityGrid(df, 'latitude', 'longitude', shape=(64, 64))
+
+    values, total = grid.query(2015, 2024, weight='injuries')
+    assert not np.isnan(values).any()
+    drawn = df['borough'].notna() & df['latitude'].notna()
+    assert total == pytest.approx(df.loc[drawn, 'number_of_persons_injured'].sum())
+    nd.generate_density_map(grid, 2015, 2024, weight='injuries')
@@ -0,0 +1,93 @@
+"""
+Tests that /export streams exactly the rows matching its filters, as CSV or as parquet row groups.
+Run from project root: pytest tests/test_export.py
+"""
+import io
+import os
+import sys
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from flask import Flask
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import export
+from bitmap_index import BitmapIndex
+from nyc_open_data_api import NYCOpenDataAPI
+from synthetic import generate_collisions, clean_collisions
+
+QUERY = {'yr_start': 2017, 'yr_end': 2021, 'borough': ['Queens', 'Bronx'], 'crash_time': ['08-09', '17-18']}
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(5000, yr_start=2015, yr_end=2024))
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['masks', 'bitmap_index'])
+def client(df, request):
+    server = Flask(__name__)
+    # small batches so the export spans several chunks and row groups
+    export.register(server, df, index=BitmapIndex(df) if request.param else None, batch_rows=37)
+    return server.test_client()
+
+
+def expected_rows(df):
+    return NYCOpenDataAPI.crossfilter(df, QUERY['yr_start'], QUERY['yr_end'], boroughs=QUERY['borough'],
+                                      filters={'crash_time': QUERY['crash_time']}).reset_index(drop=True)
+
+
+def test_csv_export_streams_matching_rows(df, client):
+    response = client.get('/export', query_string=dict(QUERY, format='csv'))
+    assert response.status_code == 200
+    assert response.is_streamed
+
+    exported = pd.read_csv(io.BytesIO(response.data), parse_dates=['crash_date'])
+    expected = expected_rows(df)
+    assert len(exported) == len(expected) > 37
+    assert exported['crash_date'].tolist() == expected['crash_date'].tolist()
+    assert exported['on_street_name'].fillna('').tolist() == expected['on_street_name'].fillna('').tolist()
+
+
+def test_parquet_export_writes_one_row_group_per_batch(df, client):
+    response = client.get('/export', query_string=dict(QUERY, format='parquet'))
+    assert response.status_code == 200
+
+    parquet = pq.ParquetFile(io.BytesIO(response.data))
+    expected = expected_rows(df)
+    assert parquet.metadata.num_row_groups == -(-len(expected) // 37)
+    pd.testing.assert_frame_equal(parquet.read().to_pandas(), expected, check_dtype=False)
+
+
+def test_export_rejects_bad_queries(client):
+    assert client.get('/export?format=xlsx').status_code == 400
+    assert client.get('/export?yr_start=soon').status_code == 400
+
+
+def test_years_left_out_by_the_memory_budget_are_rejected(df):
+    server = Flask(__name__)
+    export.register(server, df[df['crash_date'].dt.year >= 2020], loaded_from=2020)
+    client = server.test_client()
+
+    response = client.get('/export', query_string={'yr_start': 2018, 'yr_end': 2021})
+    assert response.status_code == 400 and b'2020' in response.data
+    exported = pd.read_csv(io.BytesIO(client.get('/export').data), parse_dates=['crash_date'])
+    assert len(exported) == (df['crash_date'].dt.year >= 2020).sum()
+
+
+def test_partly_loaded_year_is_exported_and_flagged(df):
+    # the budget only fit the most recent rows of the newest year
+    newest = df[df['crash_date'].dt.year == 2024].sort_values('crash_date').tail(50)
+    server = Flask(__name__)
+    export.register(server, newest, loaded_from=2024, partial_year=2024)
+    client = server.test_client()
+
+    response = client.get('/export')
+    assert response.status_code == 200 and response.headers['X-Partial-Year'] == '2024'
+    assert len(pd.read_csv(io.BytesIO(response.data))) == 50
+    assert client.get('/export', query_string={'yr_start': 2023}).status_code == 400
@@ -0,0 +1,129 @@
+"""
+Offline tests of NYCOpenDataAPI's fetch path against the mock SODA server.
+Run from project root: pytest tests/test_fetch_offline.py
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from nyc_open_data_api import NYCOpenDataAPI
+from mock_soda import MockSodaServer, run_query
+from synthetic import generate_collisions, COLUMNS
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return generate_collisions(5000, yr_start=2020, yr_end=2024)
+
+
+@pytest.fixture
+def mock(dataset):
+    with MockSodaServer(dataset) as server:
+        yield server
+
+
+def test_run_query_where_order_and_paging(dataset):
+    params = {'$where': "CRASH_DATE >= '2023-01-01T00:00:00.000' AND LATITUDE IS NOT NULL",
+              '$order': 'CRASH_DATE DESC, :id', '$limit': '100', '$offset': '50',
+              '$select': 'crash_date,borough'}
+    result = run_query(dataset, params)
+
+    expected = dataset[(dataset['crash_date'] >= '2023') & dataset['latitude'].notna()]
+    expected = expected.sort_values('crash_date', ascending=False, kind='stable').iloc[50:150]
+    assert list(result.columns) == ['crash_date', 'borough']
+    assert result.index.tolist() == expected.index.tolist()
+
+
+def test_fetch_data_pages_match_single_request(mock):
+    api = NYCOpenDataAPI(mock.url, key=None)
+    whole = api.fetch_data(columns=COLUMNS, limit=2500, yr_start=2021, yr_end=2023)
+    paged = api.fetch_data(columns=COLUMNS, limit=2500, yr_start=2021, yr_end=2023, page_size=700)
+
+    assert len(whole) == 2500
+    assert whole.equals(paged)
+
+
+def test_fetch_data_retries_through_throttling(mock):
+    mock.configure({'fail_first': 2, 'error_statuses': '429'})
+    api = NYCOpenDataAPI(mock.url, key=None)
+    df = api.fetch_data(columns=COLUMNS, limit=10)
+
+    assert len(df) == 10
+    assert mock.stats()['requests'] == 3
+
+
+def test_fetch_data_gives_up_after_retries(mock):
+    mock.configure({'error_rate': 1.0, 'error_statuses': '500'})
+    api = NYCOpenDataAPI(mock.url, key=None)
+
+    assert api.fetch_data(columns=COLUMNS, limit=10) is None
+
+
+def test_fetch_aggregate_matches_local_groupby(mock, dataset, tmp_path):
+    from synthetic import clean_collisions
+    import components.nyc_collision_map as nd
+
+    api = NYCOpenDataAPI(mock.url, key=None, cache_dir=str(tmp_path))
+    cols = ['contributing_factor_vehicle_1', 'crash_time']
+    counts = api.fetch_aggregate(cols)
+    rows = clean_collisions(dataset.copy())
+
+    local = nd.generate_sankey(rows, cols, yr_start=2021, yr_end=2022, boroughs=['Queens', 'Bronx'])
+    remote = nd.generate_sankey_from_counts(counts, cols, yr_start=2021, yr_end=2022, boroughs=['Queens', 'Bronx'])
+    assert list(local.data[0].link.value) == list(remote.data[0].link.value)
+    assert list(local.data[0].node.label) == list(remote.data[0].node.label)
+
+    # second lookup is served from the cache, also after a restart via the files on disk
+    requests_before = mock.stats()['requests']
+    assert api.fetch_aggregate(cols) is counts
+    assert NYCOpenDataAPI(mock.url, key=None, cache_dir=str(tmp_path)).fetch_aggregate(cols).equals(counts)
+    assert mock.stats()['requests'] == requests_before
+
+
+def test_fetch_aggregate_pages_past_the_limit(mock):
+    cols = ['contributing_factor_vehicle_1', 'crash_time']
+    whole = NYCOpenDataAPI(mock.url, key=None).fetch_aggregate(cols)
+
+    mock.reset_counters()
+    paged = NYCOpenDataAPI(mock.url, key=None).fetch_aggregate(cols, page_size=300)
+    assert len(whole) > 300 and mock.stats()['requests'] > len(whole) // 300
+    pd.testing.assert_frame_equal(paged, whole)
+
+
+def test_fetch_data_if_modified_revalidates(mock):
+    api = NYCOpenDataAPI(mock.url, key=None)
+    assert api.rows_updated_at() == mock.rows_updated_at
+
+    df, validators, modified = api.fetch_data_if_modified(columns=COLUMNS, limit=2000)
+    assert modified and len(df) == 2000 and validators['etag']
+    assert df.equals(api.fetch_data(columns=COLUMNS, limit=2000))
+
+    # unchanged rows are answered with an empty 304
+    mock.reset_counters()
+    df, same, modified = api.fetch_data_if_modified(validators, columns=COLUMNS, limit=2000)
+    assert df is None and not modified and same == validators
+    assert mock.stats()['not_modified'] == 1 and mock.stats()['bytes_sent'] == 0
+
+    # validators of another query are not sent
+    df, _, modified = api.fetch_data_if_modified(validators, columns=COLUMNS, limit=1000)
+    assert modified and len(df) == 1000
+
+    # once the portal publishes new rows they are fetched again
+    mock.configure({'rows_updated_at': mock.rows_updated_at + 60})
+    assert api.rows_updated_at() == mock.rows_updated_at
+    df, changed, modified = api.fetch_data_if_modified(validators, columns=COLUMNS, limit=2000)
+    assert modified and len(df) == 2000 and changed['etag'] != validators['etag']
+
+
+def test_fetch_data_is_gzipped(mock):
+    api = NYCOpenDataAPI(mock.url, key=None)
+    df = api.fetch_data(columns=COLUMNS, limit=2000)
+
+    assert mock.stats()['bytes_sent'] < len(df.to_csv(index=False).encode()) / 2
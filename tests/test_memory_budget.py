@@ -0,0 +1,102 @@
+"""
+Tests for choosing and loading the rows kept resident under --memory-budget.
+Run from project root: pytest tests/test_memory_budget.py
+"""
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+from columnar_store import compact, read_columnar, write_columnar
+from memory_budget import MIN_ROWS, estimate_row_bytes, process_rss, read_parquet_years, resident_years, \
+    rows_within_budget
+from mock_soda import MockSodaServer
+from synthetic import generate_collisions, clean_collisions
+
+
+def test_resident_years_keeps_newest_whole_years():
+    year_counts = pd.Series({2020: 100, 2021: 120, 2022: 90, 2023: 110})
+
+    assert resident_years(year_counts, 1000) == (2020, 420)
+    assert resident_years(year_counts, 300) == (2022, 200)
+    assert resident_years(year_counts, 200) == (2022, 200)
+    # not even the newest year fits, so only part of it is kept
+    assert resident_years(year_counts, 50) == (2023, 50)
+
+
+def test_budget_prices_compact_rows():
+    df = clean_collisions(generate_collisions(5000))
+    row_bytes = estimate_row_bytes(df)
+
+    # compacted rows cost far less than pandas' object columns
+    assert 0 < row_bytes < df.memory_usage(deep=True).sum() / len(df)
+    assert rows_within_budget(200e6, row_bytes, used_bytes=50e6) > rows_within_budget(100e6, row_bytes, used_bytes=50e6)
+    assert rows_within_budget(10e6, row_bytes, used_bytes=50e6) == MIN_ROWS
+
+
+def test_read_parquet_years_matches_columnar(tmp_path):
+    df = clean_collisions(generate_collisions(20000, yr_start=2015, yr_end=2024))
+    df.to_parquet(tmp_path / 'collisions.parquet')
+    write_columnar(df, tmp_path / 'collisions.ncol')
+
+    resident = compact(read_parquet_years(tmp_path / 'collisions.parquet', 2021, batch_rows=3000))
+    mapped = read_columnar(tmp_path / 'collisions.ncol')
+    expected = mapped[mapped['crash_date'].dt.year >= 2021].reset_index(drop=True)
+
+    assert len(resident) == (df['crash_date'].dt.year >= 2021).sum()
+    assert resident.dtypes.astype(str).tolist() == expected.dtypes.astype(str).tolist()
+    pd.testing.assert_frame_equal(resident.astype(object), expected.astype(object))
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='needs /proc')
+def test_process_rss_is_current_not_peak():
+    before = process_rss()
+    block = np.ones(50_000_000, dtype=np.uint8)
+    assert process_rss() > before + 40e6
+    del block
+    assert process_rss() < before + 10e6
+
+
+# starts the dashboard in the current directory, printing what it loaded and what /export and the API answer
+STARTUP = """
+import json, sys
+sys.path.insert(0, {backend!r})
+sys.argv = ['main.py', '--no-debug', '--url', {url!r}, '--memory-budget', '1']
+import main
+client = main.server.test_client()
+export = client.get('/export')
+print(json.dumps({{'loaded_from': main.loaded_from, 'partial_year': main.partial_year, 'rows': len(main.df),
+                  'slider': [main.yr_min, main.yr_max], 'aggregate_before': main.aggregate_before,
+                  'export_rows': export.data.count(b'\\n') - 1,
+                  'export_partial': export.headers.get('X-Partial-Year'),
+                  'totals': client.get('/api/v1/totals').get_json()}}))
+"""
+
+
+def test_budget_run_loads_the_same_from_its_cache(tmp_path):
+    # the 1MB budget only fits MIN_ROWS, fewer than the newest year holds
+    with MockSodaServer(generate_collisions(60_000, yr_start=2021, yr_end=2024)) as mock:
+        script = STARTUP.format(backend=os.path.join(PROJECT_ROOT, 'backend'), url=mock.url)
+        runs = []
+        for _ in range(2):
+            done = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, capture_output=True, text=True,
+                                  timeout=300)
+            assert done.returncode == 0, done.stderr
+            runs.append((done.stdout, json.loads(done.stdout.strip().splitlines()[-1])))
+
+    (fetched_log, fetched), (cached_log, cached) = runs
+    assert 'Fetching from API' in fetched_log and 'Loading from cache' in cached_log
+    assert fetched == cached
+    assert fetched['loaded_from'] == fetched['partial_year'] == 2024 and fetched['rows'] == MIN_ROWS
+    assert fetched['slider'] == [2021, 2024] and fetched['aggregate_before'] == 2025
+    assert fetched['export_rows'] == fetched['totals']['collisions'] == MIN_ROWS
+    assert fetched['export_partial'] == '2024' and fetched['totals']['partial_year'] == 2024
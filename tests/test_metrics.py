@@ -0,0 +1,45 @@
+"""
+Tests for the Prometheus instrumentation in backend/metrics.py.
+Run from project root: pytest tests/test_metrics.py
+"""
+import os
+import sys
+
+from flask import Flask
+
+# Add backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    hist = metrics.Histogram('test_seconds', 'Test histogram.', ['stage'], (0.1, 1))
+    hist.observe(0.05, stage='filter')
+    hist.observe(0.5, stage='filter')
+    hist.observe(5, stage='filter')
+
+    lines = hist.render().splitlines()
+    assert lines[1] == '# TYPE test_seconds histogram'
+    assert 'test_seconds_bucket{stage="filter",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="filter",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="filter",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="filter"} 3' in lines
+
+
+def test_metrics_route_reports_callback_payloads():
+    server = Flask(__name__)
+    metrics.register(server)
+
+    @server.route('/_dash-update-component', methods=['POST'])
+    @metrics.instrument('test_callback')
+    def update():
+        return 'x' * 2048
+
+    client = server.test_client()
+    client.post('/_dash-update-component', json={'output': 'graph.figure'})
+    body = client.get('/metrics').data.decode()
+
+    assert 'dashboard_callback_seconds_count{callback="test_callback"} 1' in body
+    assert 'dashboard_response_bytes_sum{output="graph.figure"} 2048' in body
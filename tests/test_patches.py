@@ -0,0 +1,125 @@
+"""
+Tests that the dash.Patch updates of the figure generators leave the browser with the same
+figure a full rebuild would produce.
+Run from project root: pytest tests/test_patches.py
+"""
+import json
+import os
+import sys
+
+import pytest
+import plotly.io as pio
+from plotly.io.json import to_json_plotly
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import components.nyc_collision_map as nd
+from synthetic import generate_collisions, clean_collisions
+
+HIST_COLS = ['number_of_persons_injured', 'number_of_persons_killed']
+SANKEY_COLS = ['contributing_factor_vehicle_1', 'vehicle_type_code1']
+
+
+def apply_patch(figure, patch):
+    """
+    :param figure: figure dict as held by the browser
+    :param patch: dash Patch returned by a callback
+    :return: returns figure with the patch's Assign and Extend operations applied, like the Dash renderer does
+    """
+    for op in json.loads(to_json_plotly(patch.to_plotly_json()))['operations']:
+        *path, last = op['location']
+        target = figure
+        for key in path:
+            target = target[key]
+        if op['operation'] == 'Assign':
+            target[last] = op['params']['value']
+        elif op['operation'] == 'Extend':
+            target[last].extend(op['params']['value'])
+        else:
+            raise AssertionError(f"unexpected operation {op['operation']}")
+    return figure
+
+
+def as_browser_figure(fig):
+    return json.loads(pio.to_json(fig))
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(5000, yr_start=2015, yr_end=2024))
+
+
+@pytest.fixture(scope='module')
+def boroughs(df):
+    return df['borough'].dropna().unique().tolist()
+
+
+@pytest.mark.parametrize('before, after', [([2018, 2020], [2017, 2022]),   # grows, only added years sent
+                                           ([2017, 2022], [2019, 2020]),   # shrinks
+                                           ([2016, 2018], [2020, 2023])])  # moves
+def test_map_patch_matches_rebuild(df, boroughs, before, after):
+    old = nd.generate_nyc_map(df, 'latitude', 'longitude', *before, boroughs=boroughs)
+    patch, traces = nd.generate_nyc_map_patch(df, 'latitude', 'longitude', *after, boroughs=boroughs,
+                                              previous_years=before,
+                                              previous_traces=[trace.name for trace in old.data])
+    patched = apply_patch(as_browser_figure(old), patch)
+    rebuilt = as_browser_figure(nd.generate_nyc_map(df, 'latitude', 'longitude', *after, boroughs=boroughs))
+
+    assert traces == [trace['name'] for trace in rebuilt['data']]
+    assert patched['layout'] == rebuilt['layout']
+    for patched_trace, rebuilt_trace in zip(patched['data'], rebuilt['data']):
+        # the order of points inside a trace doesn't matter
+        assert sorted(zip(patched_trace['lat'], patched_trace['lon'], patched_trace['hovertext'])) == \
+            sorted(zip(rebuilt_trace['lat'], rebuilt_trace['lon'], rebuilt_trace['hovertext']))
+
+    if after[0] <= before[0] and after[1] >= before[1]:
+        # growing the range sends fewer points than the whole map holds
+        sent = sum(len(op['params']['value']) for op in patch.to_plotly_json()['operations']
+                   if op['location'][-1] == 'lat')
+        assert sent < sum(len(trace['lat']) for trace in rebuilt['data'])
+
+
+def test_map_patch_rebuilds_when_traces_change(df, boroughs):
+    patch, traces = nd.generate_nyc_map_patch(df, 'latitude', 'longitude', 2018, 2020, boroughs=boroughs,
+                                              previous_years=[2018, 2020], previous_traces=boroughs[:2])
+    assert patch is None
+    assert traces == boroughs
+
+
+def test_sankey_and_hist_patches_match_rebuild(df, boroughs):
+    old_sankey = nd.generate_sankey(df, SANKEY_COLS, 2016, 2017, boroughs=boroughs)
+    patch = nd.generate_sankey(df, SANKEY_COLS, 2020, 2023, boroughs=boroughs[:2], patch=True)
+    rebuilt = nd.generate_sankey(df, SANKEY_COLS, 2020, 2023, boroughs=boroughs[:2])
+    patched = apply_patch(as_browser_figure(old_sankey), patch)
+    assert patched['data'][0]['node']['label'] == list(rebuilt.data[0].node.label)
+    for key in ('source', 'target', 'value'):
+        assert patched['data'][0]['link'][key] == list(rebuilt.data[0].link[key])
+
+    old_hist = nd.generate_hist(df, HIST_COLS, 2016, 2017, boroughs=boroughs)
+    patch = nd.generate_hist(df, HIST_COLS, 2020, 2023, boroughs=boroughs[:2], patch=True)
+    patched = apply_patch(as_browser_figure(old_hist), patch)
+    rebuilt = nd.generate_hist(df, HIST_COLS, 2020, 2023, boroughs=boroughs[:2])
+    for patched_trace, rebuilt_trace in zip(patched['data'], rebuilt.data):
+        assert patched_trace['x'] == list(rebuilt_trace.x)
+
+
+def test_map_patch_with_changed_filters_matches_rebuild(df, boroughs):
+    from bitmap_index import BitmapIndex
+    index = BitmapIndex(df)
+    filters = {'vehicle_type_code1': index.values('vehicle_type_code1')[:3]}
+
+    old = nd.generate_nyc_map(df, 'latitude', 'longitude', 2018, 2020, boroughs=boroughs)
+    # the same years with new filters can't be extended, so every trace is reassigned
+    patch, traces = nd.generate_nyc_map_patch(df, 'latitude', 'longitude', 2018, 2021, boroughs=boroughs,
+                                              previous_years=None,
+                                              previous_traces=[trace.name for trace in old.data],
+                                              filters=filters, index=index)
+    patched = apply_patch(as_browser_figure(old), patch)
+    rebuilt = as_browser_figure(nd.generate_nyc_map(df, 'latitude', 'longitude', 2018, 2021, boroughs=boroughs,
+                                                    filters=filters))
+    assert patched['layout'] == rebuilt['layout']
+    for patched_trace, rebuilt_trace in zip(patched['data'], rebuilt['data']):
+        assert patched_trace['lat'] == rebuilt_trace['lat']
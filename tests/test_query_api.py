@@ -0,0 +1,118 @@
+"""
+Tests that the JSON API returns the counts the dashboard computes, with ETags and keyset pagination.
+Run from project root: pytest tests/test_query_api.py
+"""
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import query_api
+from bitmap_index import BitmapIndex
+from nyc_open_data_api import NYCOpenDataAPI
+from synthetic import generate_collisions, clean_collisions
+
+VIEW = {'yr_start': 2017, 'yr_end': 2021, 'borough': ['Queens', 'Bronx'], 'crash_time': ['08-09', '17-18']}
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(5000, yr_start=2015, yr_end=2024))
+
+
+@pytest.fixture(scope='module')
+def client(df):
+    server = Flask(__name__)
+    query_api.register(server, df, index=BitmapIndex(df))
+    return server.test_client()
+
+
+@pytest.fixture(scope='module')
+def expected(df):
+    return NYCOpenDataAPI.crossfilter(df, VIEW['yr_start'], VIEW['yr_end'], boroughs=VIEW['borough'],
+                                      filters={'crash_time': VIEW['crash_time']})
+
+
+def test_counts_match_the_dashboard(client, expected):
+    totals = client.get('/api/v1/totals', query_string=VIEW).get_json()
+    assert totals == {'collisions': len(expected),
+                      'persons_injured': int(expected['number_of_persons_injured'].sum()),
+                      'persons_killed': int(expected['number_of_persons_killed'].sum())}
+
+    boroughs = client.get('/api/v1/boroughs', query_string=VIEW).get_json()['boroughs']
+    assert boroughs == expected['borough'].value_counts().to_dict()
+
+    cols = ['contributing_factor_vehicle_1', 'vehicle_type_code1']
+    counts = client.get('/api/v1/counts', query_string=dict(VIEW, group_by=cols, limit=10)).get_json()['counts']
+    top = expected.groupby(cols).size().sort_values(ascending=False).head(10)
+    assert [row['count'] for row in counts] == top.tolist()
+
+    bins = client.get('/api/v1/histogram', query_string=dict(VIEW, column='number_of_persons_injured')).get_json()
+    percents = expected['number_of_persons_injured'].value_counts(normalize=True).sort_index() * 100
+    assert [b['value'] for b in bins['bins']] == percents.index.tolist()
+    assert [b['percent'] for b in bins['bins']] == pytest.approx(percents.tolist())
+
+
+def test_etag_answers_repeated_queries_with_304(client):
+    first = client.get('/api/v1/totals', query_string=VIEW)
+    etag = first.headers['ETag']
+    assert client.get('/api/v1/totals', query_string=VIEW, headers={'If-None-Match': etag}).status_code == 304
+    other = client.get('/api/v1/totals', query_string=dict(VIEW, yr_end=2022), headers={'If-None-Match': etag})
+    assert other.status_code == 200 and other.headers['ETag'] != etag
+
+
+def test_collisions_are_paginated_by_keyset(client, expected):
+    ids, after = [], None
+    while True:
+        query = dict(VIEW, limit=40, fields=['crash_date', 'borough'])
+        if after is not None:
+            query['after'] = after
+        page = client.get('/api/v1/collisions', query_string=query).get_json()
+        assert all(set(row) == {'id', 'crash_date', 'borough'} for row in page['data'])
+        ids += [row['id'] for row in page['data']]
+        after = page['next']
+        if after is None:
+            break
+
+    assert ids == expected.index.tolist()
+
+
+def test_bad_queries_are_rejected(client):
+    for path in ('/api/v1/counts?group_by=latitude', '/api/v1/histogram?column=borough',
+                 '/api/v1/collisions?limit=0', '/api/v1/totals?yr_start=soon', '/api/v1/collisions?fields=nope'):
+        response = client.get(path)
+        assert response.status_code == 400 and 'error' in response.get_json()
+
+
+def test_internal_errors_are_not_reported_as_bad_queries(df, monkeypatch):
+    server = Flask(__name__)
+    query_api.register(server, df)
+    monkeypatch.setattr(query_api, 'totals', lambda df, rows: int('not a count'))
+    assert server.test_client().get('/api/v1/totals').status_code == 500
+
+
+def test_years_left_out_by_the_memory_budget_are_rejected(df):
+    server = Flask(__name__)
+    query_api.register(server, df[df['crash_date'].dt.year >= 2020], loaded_from=2020)
+    client = server.test_client()
+
+    response = client.get('/api/v1/totals?yr_start=2012&yr_end=2013')
+    assert response.status_code == 400 and '2020' in response.get_json()['error']
+    assert client.get('/api/v1/totals').get_json()['collisions'] == (df['crash_date'].dt.year >= 2020).sum()
+
+
+def test_partly_loaded_year_is_answered_and_flagged(df):
+    # the budget only fit the most recent rows of the newest year
+    newest = df[df['crash_date'].dt.year == 2024].sort_values('crash_date').tail(50)
+    server = Flask(__name__)
+    query_api.register(server, newest, loaded_from=2024, partial_year=2024)
+    client = server.test_client()
+
+    assert client.get('/api/v1/totals').get_json() == dict(query_api.totals(newest, range(50)), partial_year=2024)
+    assert client.get('/api/v1/totals?yr_start=2024&yr_end=2024').get_json()['collisions'] == 50
@@ -0,0 +1,55 @@
+"""
+Tests that the stratified sample keeps a bounded number of rows per (year, borough) and that its
+weights scale back to the exact counts.
+Run from project root: pytest tests/test_stratified_sample.py
+"""
+import os
+import sys
+
+import pytest
+
+# Add tests/ and backend/ to path so imports work from the tests/ folder
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'tests'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'backend'))
+
+import components.nyc_collision_map as nd
+from stratified_sample import StratifiedSample, WEIGHT_COLUMN
+from synthetic import generate_collisions, clean_collisions
+
+
+@pytest.fixture(scope='module')
+def df():
+    return clean_collisions(generate_collisions(20000, yr_start=2015, yr_end=2024))
+
+
+def test_sample_is_bounded_and_weights_scale_to_exact_counts(df):
+    sample = StratifiedSample(df, per_stratum=50)
+    strata = [sample.df['crash_date'].dt.year, sample.df['borough']]
+    full_strata = [df['crash_date'].dt.year, df['borough']]
+
+    assert sample.df.groupby(strata, dropna=False).size().max() == 50
+    weights = sample.df.groupby(strata, dropna=False)[WEIGHT_COLUMN].sum().round()
+    assert weights.astype(int).to_dict() == df.groupby(full_strata, dropna=False).size().to_dict()
+
+    assert sample.count(2017, 2020) == df['crash_date'].dt.year.between(2017, 2020).sum()
+    assert sample.count(2017, 2020, ['Queens']) == \
+        (df['crash_date'].dt.year.between(2017, 2020) & (df['borough'] == 'Queens')).sum()
+
+    # every sampled row is a row of the full dataset
+    assert (df.iloc[sample.positions]['crash_date'].to_numpy() == sample.df['crash_date'].to_numpy()).all()
+
+
+def test_sampled_views_are_marked_and_estimate_totals(df):
+    sample = StratifiedSample(df, per_stratum=50)
+    boroughs = df['borough'].dropna().unique().tolist()
+
+    sampled = nd.generate_nyc_map(sample.df, 'latitude', 'longitude', 2016, 2023, boroughs=boroughs,
+                                  index=sample.index, weight=WEIGHT_COLUMN)
+    exact = nd.generate_nyc_map(df, 'latitude', 'longitude', 2016, 2023, boroughs=boroughs)
+    assert [a.text.replace('~', '').replace(' (sampled)', '') for a in sampled.layout.annotations] == \
+        [a.text for a in exact.layout.annotations]
+
+    hist = nd.generate_hist(sample.df, ['number_of_persons_injured'], 2016, 2023, boroughs=boroughs,
+                            index=sample.index, weight=WEIGHT_COLUMN)
+    assert hist.layout.title.text.endswith('(sampled)')